@@ -0,0 +1,116 @@
+"""Аналитика по записям на NumPy: загрузка и векторные сводки по технике и контрагентам.
+
+Записи приходят столбцами целых чисел (см. ANALYTICS_COLUMNS в app.py):
+день как число дней от 1970-01-01, id техники, код статуса, часы, id контрагента
+(0 — без контрагента). Группировки считаются через bincount по составному ключу
+(период, техника), без циклов по строкам. Хранятся только группы, в которых есть
+записи, так что память растёт с числом записей, а не с числом техники × периодов.
+"""
+import itertools
+
+import numpy as np
+
+DAY, MACHINE, STATUS, HOURS, COUNTERPARTY = range(5)
+COLUMN_COUNT = 5
+
+MACHINE_FIELDS = ('records', 'work_days', 'utilization', 'work_hours', 'repair_days',
+                  'stop_days', 'stop_streaks', 'longest_stop')
+
+
+LOAD_BLOCK = 20000
+
+
+def load_columns(cursor):
+    """Столбцы (COLUMN_COUNT, n) из курсора.
+
+    Строки читаются блоками fetchmany по LOAD_BLOCK: у курсора с замером
+    времени (InstrumentedCursor) он снимается раз на блок, а не на строку.
+    """
+    blocks = []
+    while True:
+        rows = cursor.fetchmany(LOAD_BLOCK)
+        if not rows:
+            break
+        blocks.append(np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64,
+                                  count=len(rows) * COLUMN_COUNT))
+    flat = np.concatenate(blocks) if blocks else np.empty(0, np.int64)
+    return flat.reshape(-1, COLUMN_COUNT).T
+
+
+def periods(first_day, last_day, monthly):
+    """Номер периода для каждого дня [first_day, last_day], дни в периодах и их начала.
+
+    monthly=False — весь диапазон один период. Начала — datetime64[D].
+    """
+    calendar = np.arange(first_day, last_day + 1)
+    if not monthly:
+        return np.zeros(len(calendar), np.int64), np.array([len(calendar)]), calendar[:1].astype('datetime64[D]')
+    months = calendar.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    bucket = months - months[0]
+    starts = (months[0] + np.arange(bucket[-1] + 1)).astype('datetime64[M]').astype('datetime64[D]')
+    return bucket, np.bincount(bucket), starts
+
+
+def machine_stats(columns, first_day, last_day, codes, monthly=True):
+    """Показатели техники по периодам.
+
+    codes — коды статусов 'work', 'repair', 'stop'. Возвращает (id техники,
+    начала периодов, {поле MACHINE_FIELDS: значения}) — массивы по группам
+    (период, техника) с записями, по порядку периодов и id техники. Дни
+    считаются без повторов: две записи одного дня — один день. Серии простоя —
+    подряд идущие дни со статусом stop, на границе периода серия разрезается.
+    """
+    day, machine, status, hours = columns[DAY], columns[MACHINE], columns[STATUS], columns[HOURS]
+    offset = day - first_day
+    bucket_of_day, bucket_days, starts = periods(first_day, last_day, monthly)
+    machines, machine_index = np.unique(machine, return_inverse=True)
+    n_machines = max(len(machines), 1)
+    keys, group = np.unique(bucket_of_day[offset] * n_machines + machine_index, return_inverse=True)
+    size = len(keys)
+    # ключ (техника, день) с зазором в сутки: последний день одной техники
+    # и первый день следующей не считаются соседними
+    stride = last_day - first_day + 2
+
+    def status_days(code):
+        mask = status == code
+        day_keys = np.unique(machine_index[mask] * stride + offset[mask])
+        index, days = np.divmod(day_keys, stride)
+        return day_keys, np.searchsorted(keys, bucket_of_day[days] * n_machines + index)
+
+    work_keys, work_groups = status_days(codes['work'])
+    _, repair_groups = status_days(codes['repair'])
+    stop_keys, stop_groups = status_days(codes['stop'])
+
+    streak_start = np.ones(len(stop_keys), bool)
+    streak_start[1:] = (np.diff(stop_keys) != 1) | (np.diff(stop_groups) != 0)
+    starts_at = np.flatnonzero(streak_start)
+    lengths = np.diff(np.append(starts_at, len(stop_keys)))
+    longest = np.zeros(size, np.int64)
+    np.maximum.at(longest, stop_groups[starts_at], lengths)
+
+    bucket, index = np.divmod(keys, n_machines)
+    work_days = np.bincount(work_groups, minlength=size)
+    result = {
+        'records': np.bincount(group, minlength=size),
+        'work_days': work_days,
+        'work_hours': np.bincount(group, weights=hours * (status == codes['work']), minlength=size),
+        'utilization': 100.0 * work_days / bucket_days[bucket],
+        'repair_days': np.bincount(repair_groups, minlength=size),
+        'stop_days': np.bincount(stop_groups, minlength=size),
+        'stop_streaks': np.bincount(stop_groups[starts_at], minlength=size),
+        'longest_stop': longest,
+    }
+    return machines[index], starts[bucket], result
+
+
+def counterparty_hours(columns, first_day, last_day, monthly=True):
+    """Часы по контрагентам: (id контрагентов, начала периодов, часы) по группам (период, контрагент) с записями."""
+    mask = columns[COUNTERPARTY] != 0
+    bucket_of_day, _, starts = periods(first_day, last_day, monthly)
+    counterparties, index = np.unique(columns[COUNTERPARTY][mask], return_inverse=True)
+    n_counterparties = max(len(counterparties), 1)
+    keys, group = np.unique(bucket_of_day[columns[DAY][mask] - first_day] * n_counterparties + index,
+                            return_inverse=True)
+    hours = np.bincount(group, weights=columns[HOURS][mask], minlength=len(keys))
+    bucket, index = np.divmod(keys, n_counterparties)
+    return counterparties[index], starts[bucket], hours
@@ -1,14 +1,74 @@
+import bisect
+import csv
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import re
+import random
 import sqlite3
-from flask import Flask, request, redirect, send_file
-from datetime import datetime, timedelta
-from openpyxl import Workbook
+import tempfile
+import threading
+import time
+import zlib
+import click
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from flask import (
+    Flask, Response, g, has_app_context, jsonify, make_response, request, redirect,
+    render_template, send_file
+)
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+from markupsafe import Markup, escape
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import PatternFill, Font
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
 
+import analytics
+
+try:
+    import brotli
+except ImportError:
+    # brotli не обязателен: без него статика и ответы сжимаются только gzip
+    brotli = None
+
 app = Flask(__name__)
 app.secret_key = 'supersecretkey123'
-app.config['DATABASE'] = 'an30.db'
+app.config['DATABASE'] = os.environ.get('AN30_DATABASE', 'an30.db')
 app.config['SQLITE_TIMEOUT'] = 20
+app.config['SQLITE_CACHED_STATEMENTS'] = 256
+app.config['SQLITE_CACHE_SIZE_KB'] = 32768
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024
+# без предварительного flask migrate первый запрос воркера сам обновит схему
+app.config['AUTO_MIGRATE'] = True
+# каталог годовых архивов записей; None — рядом с DATABASE
+app.config['ARCHIVE_DIR'] = None
+app.config['PAGE_CACHE_SIZE'] = 512
+app.config['EXPORT_CACHE_DIR'] = os.environ.get('AN30_EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'an30_exports'))
+app.config['EXPORT_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+app.config['EXPORT_CACHE_MAX_AGE'] = 24 * 3600
+app.config['EXPORT_JOB_TIMEOUT'] = 3600
+app.config['EXPORT_WORKERS'] = 2
+# метрики каждого воркера сбрасываются в этот каталог, /metrics складывает их
+app.config['METRICS_DIR'] = os.environ.get('AN30_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'an30_metrics'))
+app.config['METRICS_FLUSH_INTERVAL'] = 1
+app.config['SLOW_QUERY_MS'] = 200
+# ответы короче COMPRESS_MIN_SIZE байт не сжимаются: заголовки gzip съедят выигрыш
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+# живое обновление: как часто воркер проверяет ленту изменений и сколько живёт один поток /events
+app.config['CHANGES_POLL_INTERVAL'] = 1
+app.config['SSE_STREAM_SECONDS'] = 300
+# фоновая очистка после удаления справочника: записей за одну транзакцию и пауза между ними,
+# чтобы запросы страниц и добавление записей не ждали блокировку записи
+app.config['PURGE_BATCH_SIZE'] = 2000
+app.config['PURGE_PAUSE'] = 0.05
 
 COLORS = {
     'primary': "#6C7A89",
@@ -24,688 +84,3287 @@ COLORS = {
     }
 }
 
+STATUS_LABELS = {
+    'work': 'Работа',
+    'stop': 'Простой',
+    'repair': 'Ремонт',
+    'holiday': 'Выходной'
+}
+
+# Миграции схемы: (номер, описание, функция). Номер последней применённой хранится
+# в PRAGMA user_version. Шаги идемпотентны и ничего не удаляют, новые добавляются
+# только в конец списка.
+def migrate_base_tables(conn):
+    # Таблица техники
+    conn.execute('''CREATE TABLE IF NOT EXISTS machines (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL
+    )''')
+
+    # Таблица водителей
+    conn.execute('''CREATE TABLE IF NOT EXISTS drivers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL
+    )''')
+
+    # Таблица контрагентов
+    conn.execute('''CREATE TABLE IF NOT EXISTS counterparties (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL
+    )''')
+
+    # Основная таблица записей
+    conn.execute('''CREATE TABLE IF NOT EXISTS records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date DATE NOT NULL,
+        machine_id INTEGER NOT NULL,
+        driver_id INTEGER NOT NULL,
+        start_time TEXT,
+        end_time TEXT,
+        hours INTEGER DEFAULT 0,
+        comment TEXT,
+        counterparty_id INTEGER,
+        status TEXT NOT NULL CHECK(status IN ('work', 'stop', 'repair', 'holiday')),
+        FOREIGN KEY(machine_id) REFERENCES machines(id) ON DELETE CASCADE,
+        FOREIGN KEY(driver_id) REFERENCES drivers(id) ON DELETE CASCADE,
+        FOREIGN KEY(counterparty_id) REFERENCES counterparties(id) ON DELETE SET NULL
+    )''')
+
+def migrate_app_state(conn):
+    # Служебные счётчики; data_version растёт при каждом изменении данных
+    conn.execute('''CREATE TABLE IF NOT EXISTS app_state (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )''')
+    conn.execute("INSERT OR IGNORE INTO app_state (key, value) VALUES ('data_version', 0)")
+    conn.execute("INSERT OR IGNORE INTO app_state (key, value) VALUES ('lookup_version', 0)")
+    conn.execute("INSERT OR IGNORE INTO app_state (key, value) VALUES ('data_modified', CAST(strftime('%s', 'now') AS INTEGER))")
+
+def migrate_records_indexes(conn):
+    # Индексы под запросы календаря, списка записей, отчёта и каскадных удалений
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_records_machine_date ON records (machine_id, date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_records_date_id ON records (date, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_records_driver_date ON records (driver_id, date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_records_counterparty_date ON records (counterparty_id, date)')
+
+def migrate_stats_tables(conn):
+    # Сводные таблицы часов и дней по статусам, ведутся триггерами;
+    # в базе, где записи уже есть, заполняются пересчётом
+    create_stats_schema(conn)
+    rebuild_stats(conn)
+
+def migrate_records_search(conn):
+    # Полнотекстовый индекс FTS5 по комментарию и именам, rowid = records.id.
+    # Имена копируются в индекс и обновляются триггерами справочников.
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5(
+        comment, machine, driver, counterparty,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )''')
+    add = '''
+        INSERT INTO records_fts (rowid, comment, machine, driver, counterparty) VALUES (
+            NEW.id, NEW.comment,
+            (SELECT name FROM machines WHERE id = NEW.machine_id),
+            (SELECT name FROM drivers WHERE id = NEW.driver_id),
+            (SELECT name FROM counterparties WHERE id = NEW.counterparty_id)
+        );'''
+    remove = 'DELETE FROM records_fts WHERE rowid = OLD.id;'
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS trg_records_fts_insert AFTER INSERT ON records BEGIN {add} END')
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS trg_records_fts_delete AFTER DELETE ON records BEGIN {remove} END')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_records_fts_update
+        AFTER UPDATE OF comment, machine_id, driver_id, counterparty_id ON records BEGIN {remove} {add} END''')
+    for table, column, key in (('machines', 'machine', 'machine_id'), ('drivers', 'driver', 'driver_id'),
+                               ('counterparties', 'counterparty', 'counterparty_id')):
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_rename AFTER UPDATE OF name ON {table} BEGIN
+            UPDATE records_fts SET {column} = NEW.name
+            WHERE rowid IN (SELECT id FROM records WHERE {key} = NEW.id);
+        END''')
+
+    # уже существующие записи индексируются пачками; новые с этого момента добавляет триггер
+    conn.commit()
+    last = conn.execute('SELECT MAX(id) FROM records').fetchone()[0] or 0
+    for start in range(0, last, MIGRATION_BATCH_SIZE):
+        conn.execute('''
+            INSERT INTO records_fts (rowid, comment, machine, driver, counterparty)
+            SELECT r.id, r.comment, m.name, d.name, c.name
+            FROM records r
+            JOIN machines m ON m.id = r.machine_id
+            JOIN drivers d ON d.id = r.driver_id
+            LEFT JOIN counterparties c ON c.id = r.counterparty_id
+            WHERE r.id > ? AND r.id <= ?
+              AND NOT EXISTS (SELECT 1 FROM records_fts WHERE rowid = r.id)
+        ''', (start, start + MIGRATION_BATCH_SIZE))
+        conn.commit()
+
+def migrate_archive_years(conn):
+    # годы, записи которых перенесены в отдельные файлы (archive-records)
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive_years (
+        year INTEGER PRIMARY KEY,
+        record_count INTEGER NOT NULL,
+        archived_at INTEGER NOT NULL
+    )''')
+
+# Смена как полуинтервал минут от 1970-01-01: [start_at, end_at). Конец раньше начала —
+# смена через полночь, как в calc_hours; без времени или при неверном формате — NULL.
+def interval_sql(prefix):
+    """Выражения start_at и end_at от {prefix}date, {prefix}start_time, {prefix}end_time."""
+    valid = ' AND '.join(f"{prefix}{column} GLOB '[0-2][0-9]:[0-5][0-9]'" for column in ('start_time', 'end_time'))
+    start, end = (f'(CAST(substr({prefix}{column}, 1, 2) AS INTEGER) * 60 + CAST(substr({prefix}{column}, 4, 2) AS INTEGER))'
+                  for column in ('start_time', 'end_time'))
+    start_at = f"CAST(strftime('%s', {prefix}date) AS INTEGER) / 60 + {start}"
+    return (f'CASE WHEN {valid} THEN {start_at} END',
+            f'CASE WHEN {valid} THEN {start_at} + ({end} - {start} + 1440) % 1440 END')
+
+def migrate_records_intervals(conn):
+    # Интервалы смен хранятся в строке и индексируются для проверки пересечений;
+    # ведутся триггерами, существующие записи заполняются пачками
+    add_column(conn, 'records', 'start_at', 'INTEGER')
+    add_column(conn, 'records', 'end_at', 'INTEGER')
+    start_at, end_at = interval_sql('NEW.')
+    update = f'UPDATE records SET start_at = {start_at}, end_at = {end_at} WHERE id = NEW.id;'
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS trg_records_interval_insert AFTER INSERT ON records BEGIN {update} END')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_records_interval_update
+        AFTER UPDATE OF date, start_time, end_time ON records BEGIN {update} END''')
+    start_at, end_at = interval_sql('')
+    backfill(conn, 'records', f'start_at = {start_at}, end_at = {end_at}',
+             'start_at IS NULL AND start_time IS NOT NULL AND end_time IS NOT NULL')
+    for key in ('machine_id', 'driver_id'):
+        conn.execute(f'''CREATE INDEX IF NOT EXISTS idx_records_{key.split('_')[0]}_interval
+            ON records ({key}, start_at, end_at) WHERE start_at IS NOT NULL''')
+
+def migrate_record_changes(conn):
+    # лента изменений записей для живого обновления страниц (/events);
+    # id растут монотонно, клиент продолжает с последнего полученного
+    conn.execute('''CREATE TABLE IF NOT EXISTS record_changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        action TEXT NOT NULL CHECK(action IN ('add', 'delete', 'reset')),
+        record_id INTEGER,
+        machine_id INTEGER,
+        date TEXT
+    )''')
+
+def migrate_soft_delete(conn):
+    # удалённые справочные строки сначала только помечаются, записи по ним
+    # чистит фоновая очистка; её ход хранится в purges
+    for table in LOOKUP_TABLES:
+        add_column(conn, table, 'deleted_at', 'INTEGER')
+    conn.execute('''CREATE TABLE IF NOT EXISTS purges (
+        entity TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        total INTEGER NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        started_at INTEGER NOT NULL,
+        finished_at INTEGER,
+        PRIMARY KEY (entity, entity_id)
+    )''')
+
+def migrate_database_id(conn):
+    # случайный id базы: data_version новой или пересозданной базы снова
+    # начинается с нуля, а кэш выгрузок в EXPORT_CACHE_DIR переживает её
+    conn.execute("INSERT OR IGNORE INTO app_state (key, value) VALUES ('database_id', random() & 9223372036854775807)")
+
+MIGRATIONS = (
+    (1, 'справочники и записи', migrate_base_tables),
+    (2, 'служебные счётчики app_state', migrate_app_state),
+    (3, 'индексы records', migrate_records_indexes),
+    (4, 'сводные таблицы и триггеры', migrate_stats_tables),
+    (5, 'полнотекстовый поиск по записям', migrate_records_search),
+    (6, 'реестр годовых архивов', migrate_archive_years),
+    (7, 'интервалы смен для проверки пересечений', migrate_records_intervals),
+    (8, 'лента изменений записей', migrate_record_changes),
+    (9, 'мягкое удаление справочников и фоновая очистка', migrate_soft_delete),
+    (10, 'id базы для кэша выгрузок', migrate_database_id),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_BATCH_SIZE = 5000
+
+def add_column(conn, table, column, definition):
+    # ADD COLUMN меняет только схему, существующие строки не переписываются
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def backfill(conn, table, assignments, where):
+    """Заполняет столбцы пачками по rowid, каждая пачка — своя короткая транзакция.
+
+    Писатели ждут не дольше одной пачки; прерванное заполнение продолжается
+    повторным запуском, если where отбирает ещё не заполненные строки.
+    """
+    conn.commit()
+    last = conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+    for start in range(0, last, MIGRATION_BATCH_SIZE):
+        conn.execute(f'UPDATE {table} SET {assignments} WHERE rowid > ? AND rowid <= ? AND ({where})',
+                     (start, start + MIGRATION_BATCH_SIZE))
+        conn.commit()
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    """Применяет недостающие миграции по порядку; возвращает [(номер, описание, секунды)]."""
+    applied = []
+    for number, title, step in MIGRATIONS:
+        if number <= schema_version(conn):
+            continue
+        started = time.perf_counter()
+        # IMMEDIATE: два воркера не применят один шаг одновременно
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if number <= schema_version(conn):
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append((number, title, time.perf_counter() - started))
+    return applied
+
 def init_db():
-    with app.app_context():
-        conn = sqlite3.connect(app.config['DATABASE'], timeout=app.config['SQLITE_TIMEOUT'])
-        conn.execute("PRAGMA foreign_keys = ON")
-        c = conn.cursor()
-
-        # ОЧИСТКА (УДАЛЕНИЕ) ВСЕХ ТАБЛИЦ, ЧТОБЫ НЕ БЫЛО КОНФЛИКТОВ С УЖЕ СУЩЕСТВУЮЩИМИ ТАБЛИЦАМИ
-        c.execute("DROP TABLE IF EXISTS records")
-        c.execute("DROP TABLE IF EXISTS machines")
-        c.execute("DROP TABLE IF EXISTS drivers")
-        c.execute("DROP TABLE IF EXISTS counterparties")
-
-        # Таблица техники
-        c.execute('''CREATE TABLE IF NOT EXISTS machines (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL
-        )''')
+    """Приводит схему базы app.config['DATABASE'] к последней версии, данные не трогает."""
+    conn = connect_db()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    clear_lookup_cache()
 
-        # Таблица водителей
-        c.execute('''CREATE TABLE IF NOT EXISTS drivers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL
-        )''')
+schema_checked = False
 
-        # Таблица контрагентов
-        c.execute('''CREATE TABLE IF NOT EXISTS counterparties (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL
-        )''')
+@app.before_request
+def check_schema():
+    # после первой проверки в процессе — только чтение флага
+    global schema_checked
+    if schema_checked:
+        return None
+    conn = get_db()
+    if schema_version(conn) < SCHEMA_VERSION:
+        if not app.config['AUTO_MIGRATE']:
+            return "Схема базы устарела, выполните flask migrate", 503
+        for number, title, seconds in migrate(conn):
+            print(f"Применена миграция {number} ({title}) за {seconds:.1f} с")
+    schema_checked = True
+    # очистка, прерванная перезапуском, продолжается в новом воркере
+    if conn.execute('SELECT 1 FROM purges WHERE finished_at IS NULL LIMIT 1').fetchone():
+        start_purges()
+    return None
+
+@app.cli.command('migrate')
+@click.option('--check', is_flag=True, help='Только проверить; код выхода 1, если есть неприменённые миграции.')
+def migrate_command(check):
+    """Применяет миграции схемы; запускается перед выкладкой, чтобы воркеры не ждали."""
+    conn = connect_db()
+    try:
+        version = schema_version(conn)
+        click.echo(f"Версия схемы: {version}, последняя: {SCHEMA_VERSION}")
+        if check:
+            pending = [m for m in MIGRATIONS if m[0] > version]
+            for number, title, _ in pending:
+                click.echo(f"  не применена: {number} {title}")
+            if pending:
+                raise SystemExit(1)
+            return
+        for number, title, seconds in migrate(conn):
+            click.echo(f"  {number} {title}: {seconds:.1f} с")
+    finally:
+        conn.close()
+    clear_lookup_cache()
+
+# Сводные таблицы по записям: (таблица, ключ, столбец периода, выражение периода от строки records).
+# Поддерживаются триггерами на records, поэтому учитывают и каскадные удаления.
+STATS_TABLES = (
+    ('daily_machine_stats', 'machine_id', 'date', '{row}.date'),
+    ('monthly_machine_stats', 'machine_id', 'month', 'substr({row}.date, 1, 7)'),
+    ('monthly_driver_stats', 'driver_id', 'month', 'substr({row}.date, 1, 7)'),
+    ('monthly_counterparty_stats', 'counterparty_id', 'month', 'substr({row}.date, 1, 7)'),
+)
+
+def create_stats_schema(c):
+    for table, key, period, expr in STATS_TABLES:
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+            {key} INTEGER NOT NULL,
+            {period} TEXT NOT NULL,
+            status TEXT NOT NULL,
+            record_count INTEGER NOT NULL,
+            hours INTEGER NOT NULL,
+            PRIMARY KEY ({key}, {period}, status)
+        ) WITHOUT ROWID''')
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{period} ON {table} ({period})')
+
+        add = f'''
+            INSERT INTO {table} ({key}, {period}, status, record_count, hours)
+            SELECT NEW.{key}, {expr.format(row='NEW')}, NEW.status, 1, COALESCE(NEW.hours, 0)
+            WHERE NEW.{key} IS NOT NULL
+            ON CONFLICT ({key}, {period}, status) DO UPDATE SET
+                record_count = record_count + 1,
+                hours = hours + excluded.hours;'''
+        remove = f'''
+            UPDATE {table} SET
+                record_count = record_count - 1,
+                hours = hours - COALESCE(OLD.hours, 0)
+            WHERE {key} = OLD.{key} AND {period} = {expr.format(row='OLD')} AND status = OLD.status;
+            DELETE FROM {table}
+            WHERE {key} = OLD.{key} AND {period} = {expr.format(row='OLD')} AND status = OLD.status
+              AND record_count <= 0;'''
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_insert AFTER INSERT ON records BEGIN {add} END')
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_delete AFTER DELETE ON records BEGIN {remove} END')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_update
+            AFTER UPDATE OF date, {key}, status, hours ON records BEGIN {remove} {add} END''')
+
+def stats_source_sql(key, period, expr, source='records', where=None):
+    return f'''
+        SELECT {key}, {expr.format(row='records')}, status, COUNT(*), SUM(COALESCE(hours, 0))
+        FROM {source} AS records
+        WHERE {key} IS NOT NULL {'AND ' + where if where else ''}
+        GROUP BY 1, 2, 3
+    '''
+
+def expected_stats(conn):
+    """Пересчитывает сводные таблицы по records и всем архивам во временные expected_<таблица>.
 
-        # Основная таблица записей
-        c.execute('''CREATE TABLE IF NOT EXISTS records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date DATE NOT NULL,
-            machine_id INTEGER NOT NULL,
-            driver_id INTEGER NOT NULL,
-            start_time TEXT,
-            end_time TEXT,
-            hours INTEGER DEFAULT 0,
-            comment TEXT,
-            counterparty_id INTEGER,
-            status TEXT NOT NULL CHECK(status IN ('work', 'stop', 'repair', 'holiday')),
-            FOREIGN KEY(machine_id) REFERENCES machines(id) ON DELETE CASCADE,
-            FOREIGN KEY(driver_id) REFERENCES drivers(id) ON DELETE CASCADE,
-            FOREIGN KEY(counterparty_id) REFERENCES counterparties(id) ON DELETE SET NULL
+    Архивы подключаются группами (archive_groups), итоги групп складываются
+    через upsert: одна и та же дата может быть и в records, и в архиве.
+    Перед подключением очередной группы текущая транзакция фиксируется.
+    """
+    for table, key, period, expr in STATS_TABLES:
+        conn.execute(f'DROP TABLE IF EXISTS temp.expected_{table}')
+        conn.execute(f'''CREATE TEMP TABLE expected_{table} (
+            {key}, {period}, status, record_count, hours, PRIMARY KEY ({key}, {period}, status)
         )''')
+    for years in [[]] + archive_groups(archived_years(conn)):
+        if years:
+            conn.commit()
+            attach_archives(conn, years)
+        source = f"({' UNION ALL '.join(f'SELECT {RECORD_COLUMNS} FROM archive_{year}.records' for year in years)})" \
+            if years else 'main.records'
+        for table, key, period, expr in STATS_TABLES:
+            conn.execute(f'''
+                INSERT INTO temp.expected_{table} ({key}, {period}, status, record_count, hours)
+                {stats_source_sql(key, period, expr, source)}
+                ON CONFLICT ({key}, {period}, status) DO UPDATE SET
+                    record_count = record_count + excluded.record_count, hours = hours + excluded.hours
+            ''')
+
+def drop_expected_stats(conn):
+    for table, key, period, expr in STATS_TABLES:
+        conn.execute(f'DROP TABLE IF EXISTS temp.expected_{table}')
+
+def rebuild_stats(conn):
+    # сводные таблицы включают и архивные годы; подмена — одной транзакцией
+    expected_stats(conn)
+    for table, key, period, expr in STATS_TABLES:
+        conn.execute(f'DELETE FROM main.{table}')
+        conn.execute(f'INSERT INTO main.{table} SELECT * FROM temp.expected_{table}')
+    conn.commit()
+    drop_expected_stats(conn)
+
+def restore_year_stats(conn, year):
+    # пересчёт сводных за год по records и архиву года (после переноса и удалений в архиве,
+    # где триггеров нет); архив года должен быть подключён
+    source = records_union([year])
+    for table, key, period, expr in STATS_TABLES:
+        bounds = (f'{year}-01-01', f'{year}-12-31') if period == 'date' else (f'{year}-01', f'{year}-12')
+        conn.execute(f'DELETE FROM {table} WHERE {period} BETWEEN ? AND ?', bounds)
+        conn.execute(f'INSERT INTO {table} ({key}, {period}, status, record_count, hours) '
+                     + stats_source_sql(key, period, expr, source, 'records.date BETWEEN ? AND ?'),
+                     (f'{year}-01-01', f'{year}-12-31'))
+
+def stats_mismatches(conn):
+    """Число расхождений каждой сводной таблицы с пересчётом по records и архивам."""
+    expected_stats(conn)
+    result = {}
+    for table, key, period, expr in STATS_TABLES:
+        stored = f'SELECT {key}, {period}, status, record_count, hours FROM main.{table}'
+        expected = f'SELECT {key}, {period}, status, record_count, hours FROM temp.expected_{table}'
+        result[table] = conn.execute(f'''
+            SELECT (SELECT COUNT(*) FROM ({stored} EXCEPT {expected}))
+                 + (SELECT COUNT(*) FROM ({expected} EXCEPT {stored}))
+        ''').fetchone()[0]
+    drop_expected_stats(conn)
+    # транзакция трогала только временные таблицы, но держит архивы подключёнными
+    conn.commit()
+    return result
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Пересчитывает сводные таблицы по records с нуля."""
+    conn = connect_db()
+    try:
+        rebuild_stats(conn)
+    finally:
+        conn.close()
+    click.echo('Сводные таблицы пересчитаны')
+
+@app.cli.command('check-stats')
+def check_stats_command():
+    """Сверяет сводные таблицы с records; код выхода 1 при расхождениях."""
+    conn = connect_db()
+    try:
+        mismatches = stats_mismatches(conn)
+    finally:
+        conn.close()
+    for table, count in mismatches.items():
+        click.echo(f"{table}: {'OK' if not count else f'расхождений {count}'}")
+    if any(mismatches.values()):
+        raise SystemExit(1)
+
+# Годовые архивы: записи закрытых лет переносятся в отдельные файлы <база>_<год>.db
+# с той же таблицей records и подключаются (ATTACH) только запросами, чей период
+# их задевает. Одновременно подключается не больше 10 баз (SQLITE_MAX_ATTACHED),
+# поэтому больше ARCHIVE_ATTACH_MAX лет обходятся группами (archive_groups).
+ARCHIVE_ATTACH_MAX = 10
+RECORD_COLUMNS = 'id, date, machine_id, driver_id, start_time, end_time, hours, comment, counterparty_id, status'
+
+def archive_path(year):
+    directory = app.config['ARCHIVE_DIR'] or os.path.dirname(os.path.abspath(app.config['DATABASE']))
+    name = os.path.splitext(os.path.basename(app.config['DATABASE']))[0]
+    return os.path.join(directory, f'{name}_{year}.db')
 
+def archived_years(conn, date_from=None, date_to=None):
+    """Архивные годы, пересекающиеся с периодом [date_from, date_to] ('YYYY-MM-DD' или None)."""
+    try:
+        years = [row[0] for row in conn.execute('SELECT year FROM archive_years ORDER BY year')]
+    except sqlite3.OperationalError:
+        # база ещё не дошла до миграции с реестром архивов
+        return []
+    return [year for year in years
+            if (date_from is None or f'{year}-12-31' >= date_from)
+            and (date_to is None or f'{year}-01-01' <= date_to)]
+
+def archive_groups(years):
+    return [years[i:i + ARCHIVE_ATTACH_MAX] for i in range(0, len(years), ARCHIVE_ATTACH_MAX)]
+
+def attach_archives(conn, years):
+    """Подключает архивы years (не больше ARCHIVE_ATTACH_MAX).
+
+    Если вместе с уже подключёнными выйдет больше предела, лишние отключаются.
+    ATTACH и DETACH нельзя внутри транзакции, поэтому вызывается до изменений.
+    """
+    if len(years) > ARCHIVE_ATTACH_MAX:
+        raise ValueError(f'одновременно подключается не больше {ARCHIVE_ATTACH_MAX} архивов')
+    wanted = {f'archive_{year}' for year in years}
+    attached = {row[1] for row in conn.execute('PRAGMA database_list') if row[1].startswith('archive_')}
+    if len(attached | wanted) > ARCHIVE_ATTACH_MAX:
+        detach_archives(conn, attached - wanted)
+        attached &= wanted
+    for year in years:
+        if f'archive_{year}' not in attached:
+            conn.execute(f'ATTACH DATABASE ? AS archive_{year}', (archive_path(year),))
+    return years
+
+def detach_archives(conn, schemas=None):
+    # без schemas отключаются все архивы соединения
+    if schemas is None:
+        schemas = [row[1] for row in conn.execute('PRAGMA database_list') if row[1].startswith('archive_')]
+    for schema in schemas:
+        conn.execute(f'DETACH DATABASE {schema}')
+
+def records_union(years):
+    # records вместе с архивами лет как один источник (для сводных таблиц)
+    if not years:
+        return 'records'
+    return '(' + ' UNION ALL '.join(
+        [f'SELECT {RECORD_COLUMNS} FROM main.records']
+        + [f'SELECT {RECORD_COLUMNS} FROM archive_{year}.records' for year in years]
+    ) + ')'
+
+class MergedRows:
+    """Строки нескольких курсоров, слитые по order; читаются как курсор (итерация, fetchmany, fetchall)."""
+
+    def __init__(self, parts, order, limit):
+        if order:
+            names = [column[0] for column in parts[0][1].description]
+            terms = [term.split() for term in order.split(',')]
+            indexes = [names.index(term[0]) for term in terms]
+            reverse = len(terms[0]) > 1 and terms[0][1].upper() == 'DESC'
+            rows = heapq.merge(*(self.part_rows(*part) for part in parts),
+                               key=lambda row: tuple(row[i] for i in indexes), reverse=reverse)
+        else:
+            rows = itertools.chain.from_iterable(self.part_rows(*part) for part in parts)
+        self.rows = itertools.islice(rows, limit) if limit else rows
+
+    @staticmethod
+    def part_rows(conn, cursor):
+        # у каждой группы архивов своё соединение; закрывается, когда строки кончились
+        try:
+            yield from cursor
+        finally:
+            conn.close()
+
+    def __iter__(self):
+        return self.rows
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self.rows, size))
+
+    def fetchall(self):
+        return list(self.rows)
+
+def select_records(conn, columns, where, params, order, limit=None, years=()):
+    """SELECT columns FROM records r WHERE ... ORDER BY order, дополненный архивами years.
+
+    Каждая часть UNION ALL идёт по своему индексу, SQLite сливает их по order
+    без сортировки, поэтому order ссылается на выводимые столбцы (date, id).
+    order=None — порядок не важен. Больше ARCHIVE_ATTACH_MAX лет читаются
+    группами, каждая своим соединением, и сливаются в MergedRows.
+    """
+    where_sql = ('WHERE ' + ' AND '.join(where)) if where else ''
+
+    def query(conn, schemas):
+        sql = ' UNION ALL '.join(f'SELECT {columns} FROM {schema}.records r {where_sql}' for schema in schemas)
+        sql += (f' ORDER BY {order}' if order else '') + (' LIMIT ?' if limit else '')
+        return conn.execute(sql, list(params) * len(schemas) + ([limit] if limit else []))
+
+    if len(years) <= ARCHIVE_ATTACH_MAX:
+        return query(conn, ['main'] + [f'archive_{year}' for year in attach_archives(conn, years)])
+    parts = []
+    for i, group in enumerate(archive_groups(years)):
+        part = connect_db()
+        parts.append((part, query(part, ['main'] * (i == 0) + [f'archive_{year}' for year in attach_archives(part, group)])))
+    return MergedRows(parts, order, limit)
+
+def select_recent_records(conn, columns, where, params, limit, date_from=None, date_to=None):
+    """Первые limit записей по (date DESC, id DESC); columns начинаются с r.id, r.date.
+
+    Архивы подключаются, только если страница из рабочей базы не заканчивается
+    позже последнего архивного года, как обычно и бывает для свежих страниц.
+    """
+    years = archived_years(conn, date_from, date_to)
+    rows = select_records(conn, columns, where, params, 'date DESC, id DESC', limit).fetchall()
+    if not years or (len(rows) == limit and rows[-1][1] > f'{years[-1]}-12-31'):
+        return rows
+    return select_records(conn, columns, where, params, 'date DESC, id DESC', limit, years).fetchall()
+
+def create_archive_schema(conn, schema):
+    conn.execute(f"PRAGMA {schema}.journal_mode = WAL")
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS {schema}.records (
+        id INTEGER PRIMARY KEY,
+        date DATE NOT NULL,
+        machine_id INTEGER NOT NULL,
+        driver_id INTEGER NOT NULL,
+        start_time TEXT,
+        end_time TEXT,
+        hours INTEGER DEFAULT 0,
+        comment TEXT,
+        counterparty_id INTEGER,
+        status TEXT NOT NULL
+    )''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_records_machine_date ON records (machine_id, date)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_records_date_id ON records (date, id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_records_driver_date ON records (driver_id, date)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_records_counterparty_date ON records (counterparty_id, date)')
+
+def archive_year(conn, year):
+    """Переносит записи года из records в архивный файл года; возвращает число перенесённых.
+
+    Перенос идёт пачками по id, каждая пачка — копирование и удаление в одной
+    транзакции. В WAL транзакция по двум файлам не атомарна целиком: после сбоя
+    запись может остаться в обоих, повторный запуск команды доводит перенос.
+    """
+    attach_archives(conn, [year])
+    create_archive_schema(conn, f'archive_{year}')
+    bounds = (f'{year}-01-01', f'{year}-12-31')
+    first, last = conn.execute('SELECT MIN(id), MAX(id) FROM records WHERE date BETWEEN ? AND ?', bounds).fetchone()
+    moved = 0
+    if first is not None:
+        for start in range(first - 1, last, MIGRATION_BATCH_SIZE):
+            batch = (start, start + MIGRATION_BATCH_SIZE) + bounds
+            conn.execute(f'''
+                INSERT OR IGNORE INTO archive_{year}.records ({RECORD_COLUMNS})
+                SELECT {RECORD_COLUMNS} FROM main.records WHERE id > ? AND id <= ? AND date BETWEEN ? AND ?
+            ''', batch)
+            moved += conn.execute(
+                'DELETE FROM main.records WHERE id > ? AND id <= ? AND date BETWEEN ? AND ?', batch
+            ).rowcount
+            conn.commit()
+
+    # триггеры удаления вычли перенесённое из сводных таблиц — пересчёт по архиву
+    restore_year_stats(conn, year)
+    conn.execute(f'''
+        INSERT INTO archive_years (year, record_count, archived_at)
+        VALUES (?, (SELECT COUNT(*) FROM archive_{year}.records), CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT(year) DO UPDATE SET record_count = excluded.record_count, archived_at = excluded.archived_at
+    ''', (year,))
+    bump_data_version(conn)
+    conn.commit()
+    # архив отключается сразу: команда проходит любое число лет одним соединением
+    detach_archives(conn, [f'archive_{year}'])
+    return moved
+
+def delete_from_archives(conn, column, ids):
+    """Удаляет записи с column из ids во всех архивах (каскад удаления техники, водителя, записей).
+
+    Для контрагента ссылка обнуляется, как ON DELETE SET NULL в records.
+    Вызывается вне транзакции: архивы подключаются группами, каждая группа —
+    своя транзакция. Возвращает число изменённых архивных записей.
+    """
+    marks = ','.join('?' * len(ids))
+    total = 0
+    for years in archive_groups(archived_years(conn)):
+        attach_archives(conn, years)
+        for year in years:
+            if column == 'counterparty_id':
+                changed = conn.execute(f'UPDATE archive_{year}.records SET counterparty_id = NULL WHERE counterparty_id IN ({marks})', ids).rowcount
+            else:
+                changed = conn.execute(f'DELETE FROM archive_{year}.records WHERE {column} IN ({marks})', ids).rowcount
+            if changed:
+                restore_year_stats(conn, year)
+                conn.execute(f'UPDATE archive_years SET record_count = (SELECT COUNT(*) FROM archive_{year}.records) WHERE year = ?', (year,))
+            total += changed
         conn.commit()
+    return total
+
+@app.cli.command('archive-records')
+@click.option('--before', type=int, default=None, help='Архивировать годы раньше этого (по умолчанию — текущего).')
+@click.option('--vacuum', is_flag=True, help='После переноса сжать рабочую базу (VACUUM).')
+def archive_records_command(before, vacuum):
+    """Переносит записи закрытых лет в годовые файлы архива."""
+    before = before or datetime.now().year
+    conn = connect_db()
+    try:
+        years = [int(row[0]) for row in conn.execute(
+            'SELECT DISTINCT substr(date, 1, 4) FROM records WHERE date < ? ORDER BY 1', (f'{before}-01-01',)
+        ).fetchall()]
+        for year in years:
+            started = time.perf_counter()
+            moved = archive_year(conn, year)
+            click.echo(f"{year}: перенесено {moved} записей в {archive_path(year)} за {time.perf_counter() - started:.1f} с")
+        if vacuum:
+            conn.execute('VACUUM')
+    finally:
         conn.close()
+    if not years:
+        click.echo('Закрытых лет с записями нет')
 
-def get_db():
-    conn = sqlite3.connect(app.config['DATABASE'], timeout=app.config['SQLITE_TIMEOUT'])
+class InstrumentedCursor(sqlite3.Cursor):
+    """Курсор, который складывает время выполнения и выборки в счётчики текущего запроса."""
+    sql = None
+    params = ()
+    elapsed = 0.0
+    slow_logged = False
+    ITER_CHUNK = 512
+
+    def timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.elapsed += elapsed
+            if has_app_context():
+                g.sql_time = g.get('sql_time', 0.0) + elapsed
+            if not self.slow_logged and self.elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+                self.slow_logged = True
+                if has_app_context():
+                    g.sql_slow = g.get('sql_slow', 0) + 1
+                print(f"Медленный запрос {self.elapsed * 1000:.0f} мс: {' '.join(str(self.sql).split())} {self.params!r}")
+
+    def start(self, sql, params):
+        self.sql, self.params, self.elapsed, self.slow_logged = sql, params, 0.0, False
+        if has_app_context():
+            g.sql_queries = g.get('sql_queries', 0) + 1
+
+    def execute(self, sql, params=()):
+        self.start(sql, params)
+        return self.timed(sqlite3.Cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        self.start(sql, f'<{len(seq_of_params)} строк>')
+        return self.timed(sqlite3.Cursor.executemany, sql, seq_of_params)
+
+    def fetchone(self):
+        return self.timed(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self.timed(sqlite3.Cursor.fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self.timed(sqlite3.Cursor.fetchall)
+
+    def __iter__(self):
+        # for row in cursor: время меряется на пачку из ITER_CHUNK строк, а не на каждую строку
+        while True:
+            rows = self.timed(sqlite3.Cursor.fetchmany, self.ITER_CHUNK)
+            if not rows:
+                return
+            yield from rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Connection.execute в C не вызывает self.cursor(), поэтому перехватываются оба
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+def connect_db(factory=sqlite3.Connection):
+    conn = sqlite3.connect(
+        app.config['DATABASE'],
+        timeout=app.config['SQLITE_TIMEOUT'],
+        cached_statements=app.config['SQLITE_CACHED_STATEMENTS'],
+        factory=factory
+    )
     conn.execute("PRAGMA foreign_keys = ON")
+    # WAL: читатели не блокируют писателя и наоборот; режим хранится в самом файле базы
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{int(app.config['SQLITE_CACHE_SIZE_KB'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    if app.config.get('SQL_TRACE'):
+        conn.set_trace_callback(app.config['SQL_TRACE'])
     return conn
 
-def render_base(content):
-    return f'''<!DOCTYPE html>
-<html>
-<head>
-    <title>АН-30 Учёт</title>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        * {{
-            box-sizing: border-box;
-            margin: 0;
-            padding: 0;
-        }}
-        body {{
-            font-family: 'Segoe UI', sans-serif;
-            background: {COLORS['background']};
-            color: {COLORS['primary']};
-        }}
-        .header {{
-            background: {COLORS['primary']};
-            padding: 1rem;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-        }}
-        .nav {{
-            max-width: 1200px;
-            margin: 0 auto;
-            display: flex;
-            gap: 1rem;
-        }}
-        .nav a {{
-            color: white;
-            text-decoration: none;
-            padding: 0.5rem 1rem;
-            border-radius: 4px;
-            transition: 0.3s;
-        }}
-        .nav a:hover {{
-            background: {COLORS['secondary']};
-        }}
-        .container {{
-            max-width: 1200px;
-            margin: 2rem auto;
-            padding: 0 1rem;
-        }}
-        .card {{
-            background: white;
-            border-radius: 8px;
-            padding: 1.5rem;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.05);
-            margin-bottom: 1rem;
-        }}
-        table {{
-            width: 100%;
-            border-collapse: collapse;
-            margin-top: 1rem;
-        }}
-        th, td {{
-            padding: 1rem;
-            text-align: left;
-            border-bottom: 1px solid #eee;
-        }}
-        th {{
-            background: {COLORS['primary']};
-            color: white;
-        }}
-        .status {{
-            display: inline-block;
-            padding: 0.25rem 0.75rem;
-            border-radius: 1rem;
-            font-size: 0.9em;
-        }}
-        .btn {{
-            background: {COLORS['accent']};
-            color: white;
-            padding: 0.5rem 1rem;
-            border: none;
-            border-radius: 4px;
-            cursor: pointer;
-            transition: 0.3s;
-        }}
-        .btn-danger {{
-            background: {COLORS['danger']} !important;
-        }}
-        .btn:hover {{
-            opacity: 0.9;
-        }}
-        .back-btn {{
-            background: {COLORS['secondary']};
-            margin: 1rem 0;
-        }}
-        form {{
-            display: flex;
-            gap: 1rem;
-            flex-wrap: wrap;
-        }}
-        input, select {{
-            padding: 0.5rem;
-            border: 1px solid #ddd;
-            border-radius: 4px;
-            min-width: 250px;
-        }}
-        .calendar-grid {{
-            display: grid;
-            grid-template-columns: repeat(7, 1fr);
-            gap: 0.5rem;
-        }}
-        .calendar-day {{
-            background: white;
-            padding: 1rem;
-            border-radius: 8px;
-            min-height: 120px;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-        }}
-    </style>
-</head>
-<body>
-    <header class="header">
-        <nav class="nav">
-            <a href="/">Главная</a>
-            <a href="/admin">Админка</a>
-            <a href="/export"> Отчёт</a>
-        </nav>
-    </header>
-    <div class="container">
-        {content}
-    </div>
-    <script>
-        function confirmDelete(msg) {{
-            return confirm(msg || 'Вы уверены что хотите удалить запись?');
-        }}
-    </script>
-</body>
-</html>'''
+# Соединение живёт в потоке воркера и переиспользуется запросами: открытие с
+# PRAGMA дороже самих запросов, а кэш подготовленных запросов (cached_statements)
+# живёт, пока живёт соединение. Ключ — путь и inode файла базы: после замены
+# файла (восстановление из копии) или смены DATABASE открывается новое.
+db_local = threading.local()
+
+def database_key():
+    path = app.config['DATABASE']
+    try:
+        inode = os.stat(path).st_ino
+    except OSError:
+        inode = None
+    return path, inode, app.config.get('SQL_TRACE')
+
+def get_db():
+    # соединение потока на время запроса (контекст приложения), возвращается в close_db
+    if 'db' not in g:
+        key = database_key()
+        if getattr(db_local, 'key', None) != key:
+            if getattr(db_local, 'conn', None) is not None:
+                db_local.conn.close()
+            db_local.conn, db_local.key = connect_db(InstrumentedConnection), key
+        g.db = db_local.conn
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exc):
+    # следующий запрос получает соединение без открытой транзакции и без архивов:
+    # файл архива мог смениться; если привести его в порядок не вышло — закрывается
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        conn.rollback()
+        detach_archives(conn)
+    except sqlite3.Error as e:
+        print(f"Соединение с базой закрыто после ошибки: {e}")
+        db_local.conn = db_local.key = None
+        conn.close()
+
+def get_data_state():
+    # (data_version, время последнего изменения в unix-секундах); читается один раз за запрос
+    if 'data_state' not in g:
+        state = dict(get_db().execute(
+            "SELECT key, value FROM app_state WHERE key IN "
+            "('data_version', 'data_modified', 'lookup_version', 'database_id')"
+        ).fetchall())
+        g.data_state = (state.get('data_version', 0), state.get('data_modified', 0))
+        g.lookup_version = state.get('lookup_version', 0)
+        g.database_id = state.get('database_id', 0)
+    return g.data_state
+
+def get_data_version():
+    return get_data_state()[0]
+
+def get_lookup_version():
+    get_data_state()
+    return g.lookup_version
+
+def get_database_id():
+    get_data_state()
+    return g.database_id
+
+def bump_data_version(conn):
+    # вызывается в той же транзакции, что и само изменение данных
+    conn.execute("""
+        INSERT INTO app_state (key, value) VALUES ('data_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    """)
+    conn.execute("""
+        INSERT INTO app_state (key, value) VALUES ('data_modified', CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """)
+    if has_app_context():
+        g.pop('data_state', None)
+
+def bump_lookup_version(conn):
+    # справочники изменились: кэш get_lookups() во всех воркерах перечитает их
+    conn.execute("""
+        INSERT INTO app_state (key, value) VALUES ('lookup_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    """)
+    if has_app_context():
+        g.pop('data_state', None)
+
+CHANGES_KEEP = 10000
+
+def log_changes(conn, action, rows=((None, None, None),)):
+    """Пишет в ленту изменений строки (record_id, machine_id, date) в текущей транзакции.
+
+    action 'reset' — изменение, которое страницам проще показать перезагрузкой
+    (каскадные удаления, импорт). Хранятся последние CHANGES_KEEP строк.
+    """
+    conn.executemany('INSERT INTO record_changes (action, record_id, machine_id, date) VALUES (?, ?, ?, ?)',
+                     [(action,) + tuple(row) for row in rows])
+    conn.execute('DELETE FROM record_changes WHERE id <= (SELECT MAX(id) FROM record_changes) - ?', (CHANGES_KEEP,))
+
+def get_last_change_id():
+    # с этого места страница подписывается на /events; кэшируется вместе со страницей
+    return get_db().execute('SELECT MAX(id) FROM record_changes').fetchone()[0] or 0
+
+def conditional_page(view=None, *, variant=None):
+    """Отвечает 304 без запросов и рендеринга, если у клиента актуальная версия.
+
+    ETag и Last-Modified строятся по data_version, поэтому не меняются, пока
+    не изменились данные (или не наступил новый день для страниц «по умолчанию»).
+    variant() — формат ответа, выбранный по заголовку Accept: входит в ETag,
+    а ответ получает Vary: Accept.
+    """
+    if view is None:
+        return lambda view: conditional_page(view, variant=variant)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET':
+            return view(*args, **kwargs)
+
+        version, modified = get_data_state()
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        key = f'{version}:{today:%Y-%m-%d}:{request.full_path}' + (f':{variant()}' if variant else '')
+        etag = hashlib.sha1(key.encode()).hexdigest()
+        last_modified = max(datetime.fromtimestamp(modified), today).astimezone(timezone.utc)
+
+        if request.if_none_match:
+            # сжатые ответы уходят со слабым ETag (compress_response)
+            not_modified = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since:
+            not_modified = last_modified.replace(microsecond=0) <= request.if_modified_since
+        else:
+            not_modified = False
+
+        if not_modified:
+            response = app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        if variant:
+            response.vary.add('Accept')
+        # браузер хранит копию, но перед показом обязан перепроверить её
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+# Кэш готовых страниц: {(дата, путь с параметрами): html} для текущей data_version.
+# Версия хранится в базе, поэтому изменение в любом воркере gunicorn сбрасывает кэш во всех.
+page_cache = OrderedDict()
+page_cache_version = None
+page_cache_lock = threading.Lock()
+
+def clear_page_cache():
+    global page_cache_version
+    with page_cache_lock:
+        page_cache.clear()
+        page_cache_version = None
+
+def cached_page(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        global page_cache_version
+        if request.method != 'GET':
+            return view(*args, **kwargs)
+
+        version = get_data_version()
+        # дата в ключе нужна страницам, которые по умолчанию показывают текущий месяц
+        key = (datetime.now().strftime('%Y-%m-%d'), request.full_path)
+        with page_cache_lock:
+            if page_cache_version != version:
+                page_cache.clear()
+                page_cache_version = version
+            html = page_cache.get(key)
+            if html is not None:
+                page_cache.move_to_end(key)
+                return html
+
+        html = view(*args, **kwargs)
+        if isinstance(html, str):
+            with page_cache_lock:
+                if page_cache_version == version:
+                    page_cache[key] = html
+                    while len(page_cache) > app.config['PAGE_CACHE_SIZE']:
+                        page_cache.popitem(last=False)
+        return html
+    return wrapper
+
+# Справочники техники, водителей и контрагентов ({таблица: {id: имя}}) и готовые
+# списки <option> к ним. Таблицы маленькие и меняются редко, поэтому читаются один раз
+# на lookup_version и подставляют имена вместо JOIN в запросах по records.
+LOOKUP_TABLES = ('machines', 'drivers', 'counterparties')
+lookup_cache = None
+lookup_cache_lock = threading.Lock()
+
+def clear_lookup_cache():
+    global lookup_cache
+    with lookup_cache_lock:
+        lookup_cache = None
+
+def load_lookups(conn=None):
+    """Возвращает (имена, options, id удалённых) для текущей lookup_version.
+
+    Без conn версия берётся из состояния текущего запроса; фоновые задачи
+    передают своё соединение.
+    """
+    global lookup_cache
+    if conn is None:
+        conn = get_db()
+        version = get_lookup_version()
+    else:
+        row = conn.execute("SELECT value FROM app_state WHERE key = 'lookup_version'").fetchone()
+        version = row[0] if row else 0
+    # путь к базе в ключе: замеры и проверки переключают DATABASE в одном процессе
+    key = (app.config['DATABASE'], version)
+    cached = lookup_cache
+    if cached is not None and cached[0] == key:
+        return cached[1:]
+
+    names = {
+        table: dict(conn.execute(f'SELECT id, name FROM {table} WHERE deleted_at IS NULL ORDER BY id').fetchall())
+        for table in LOOKUP_TABLES
+    }
+    deleted = {
+        table: [row[0] for row in conn.execute(f'SELECT id FROM {table} WHERE deleted_at IS NOT NULL ORDER BY id')]
+        for table in LOOKUP_TABLES
+    }
+    options = {
+        table: ''.join(f'<option value="{id}">{escape(name)}</option>' for id, name in rows.items())
+        for table, rows in names.items()
+    }
+    with lookup_cache_lock:
+        lookup_cache = (key, names, options, deleted)
+    return names, options, deleted
+
+def get_lookups(conn=None):
+    return load_lookups(conn)[0]
+
+def hidden_records_where(conn=None, alias='r'):
+    """Условия, скрывающие записи техники и водителей, которые ждут фоновой очистки."""
+    deleted = load_lookups(conn)[2]
+    where, params = [], []
+    for table, column in (('machines', 'machine_id'), ('drivers', 'driver_id')):
+        if deleted[table]:
+            where.append(f"{alias}.{column} NOT IN ({','.join('?' * len(deleted[table]))})")
+            params += deleted[table]
+    return where, params
+
+@app.template_global()
+def lookup_options(table, selected=None):
+    options = load_lookups()[1][table]
+    if selected and str(selected).isdigit():
+        options = options.replace(f'<option value="{selected}">', f'<option value="{selected}" selected>', 1)
+    return Markup(options)
+
+# Метрики в формате Prometheus. Каждый воркер gunicorn копит их в памяти и раз в
+# METRICS_FLUSH_INTERVAL секунд пишет снимок в METRICS_DIR/<pid мастера>-<pid>.json;
+# /metrics суммирует снимки всех воркеров текущего мастера, включая завершившиеся,
+# поэтому счётчики не убывают при перезапуске воркеров.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760)
+METRICS = {
+    'an30_http_request_duration_seconds': ('histogram', 'Время обработки запроса', LATENCY_BUCKETS),
+    'an30_http_response_size_bytes': ('histogram', 'Размер ответа (без потоковых)', SIZE_BUCKETS),
+    'an30_http_responses_total': ('counter', 'Ответы по кодам статуса', None),
+    'an30_sql_queries_total': ('counter', 'Запросы к SQLite', None),
+    'an30_sql_duration_seconds_total': ('counter', 'Время выполнения и выборки в SQLite', None),
+    'an30_sql_slow_queries_total': ('counter', 'Запросы к SQLite дольше SLOW_QUERY_MS', None),
+}
+METRICS_STALE_AGE = 24 * 3600
+
+# {(имя, метки): число} для счётчиков, {(имя, метки): [по корзинам..., +Inf, сумма]} для гистограмм
+metrics_values = {}
+metrics_lock = threading.Lock()
+metrics_dirty = False
+metrics_flusher = None
+
+def observe_metric(name, labels, value):
+    # вызывается под metrics_lock
+    kind, _, buckets = METRICS[name]
+    if kind == 'counter':
+        metrics_values[(name, labels)] = metrics_values.get((name, labels), 0) + value
+        return
+    histogram = metrics_values.get((name, labels))
+    if histogram is None:
+        histogram = metrics_values[(name, labels)] = [0] * (len(buckets) + 2)
+    histogram[bisect.bisect_left(buckets, value)] += 1
+    histogram[-1] += value
+
+def record_request_metrics(endpoint, method, status, duration, size, queries, sql_time, slow):
+    global metrics_dirty, metrics_flusher
+    labels = (('endpoint', endpoint), ('method', method))
+    with metrics_lock:
+        observe_metric('an30_http_request_duration_seconds', labels, duration)
+        observe_metric('an30_http_responses_total', labels + (('status', str(status)),), 1)
+        if size is not None:
+            observe_metric('an30_http_response_size_bytes', labels, size)
+        if queries:
+            observe_metric('an30_sql_queries_total', labels, queries)
+            observe_metric('an30_sql_duration_seconds_total', labels, sql_time)
+        if slow:
+            observe_metric('an30_sql_slow_queries_total', labels, slow)
+        metrics_dirty = True
+        # поток запускается в самом воркере, после fork
+        if metrics_flusher is None:
+            metrics_flusher = threading.Thread(target=flush_metrics_loop, name='metrics', daemon=True)
+            metrics_flusher.start()
+
+def metrics_snapshot():
+    with metrics_lock:
+        return [[name, list(labels), list(value) if isinstance(value, list) else value]
+                for (name, labels), value in metrics_values.items()]
+
+def metrics_file():
+    return os.path.join(app.config['METRICS_DIR'], f'{os.getppid()}-{os.getpid()}.json')
+
+def flush_metrics():
+    global metrics_dirty
+    with metrics_lock:
+        if not metrics_dirty:
+            return
+        metrics_dirty = False
+    path = metrics_file()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(metrics_snapshot(), f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"Ошибка записи метрик: {e}")
+
+def flush_metrics_loop():
+    while True:
+        time.sleep(app.config['METRICS_FLUSH_INTERVAL'])
+        flush_metrics()
+
+def collect_metrics():
+    merged = {}
+    snapshots = [metrics_snapshot()]
+    directory = app.config['METRICS_DIR']
+    own = os.path.basename(metrics_file())
+    prefix = f'{os.getppid()}-'
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        path = os.path.join(directory, name)
+        if not name.endswith('.json') or name == own:
+            continue
+        try:
+            if not name.startswith(prefix):
+                # снимки прошлых запусков сервера
+                if time.time() - os.path.getmtime(path) > METRICS_STALE_AGE:
+                    os.remove(path)
+                continue
+            with open(path, encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if isinstance(value, list):
+                total = merged.setdefault(key, [0] * len(value))
+                for i, item in enumerate(value):
+                    total[i] += item
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+def format_labels(labels):
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def render_metrics(merged):
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (sample, labels), value in sorted(merged.items()):
+            if sample != name:
+                continue
+            if kind == 'counter':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        record_request_metrics(
+            request.endpoint or 'unknown', request.method, response.status_code,
+            time.perf_counter() - started,
+            # у потоковых ответов размер заранее неизвестен (None)
+            response.content_length,
+            g.get('sql_queries', 0), g.get('sql_time', 0.0), g.get('sql_slow', 0)
+        )
+    return response
+
+# Сжатие ответов: страницы, JSON и потоки. Обработчик объявлен после record_metrics,
+# поэтому выполняется раньше него и в метрики попадает размер сжатого ответа.
+COMPRESS_MIMETYPES = ('text/html', 'text/plain', 'text/csv', 'application/json',
+                      'application/x-ndjson', 'text/event-stream')
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, app.config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+def compress_stream(source, chunks, encoding):
+    """Сжимает поток chunks (байты) по частям; каждая уходит клиенту сразу (sync flush)."""
+    try:
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+            for chunk in chunks:
+                yield compressor.process(chunk) + compressor.flush()
+            yield compressor.finish()
+        else:
+            compressor = zlib.compressobj(app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for chunk in chunks:
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+    finally:
+        # закрывает генератор ответа и его соединение с базой при обрыве клиента
+        if hasattr(source, 'close'):
+            source.close()
+
+@app.after_request
+def compress_response(response):
+    if response.status_code != 200 or response.direct_passthrough or response.content_encoding \
+            or response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+    streamed = response.is_streamed
+    if not streamed and response.content_length < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding(('br', 'gzip') if brotli else ('gzip',))
+    if encoding == 'identity':
+        return response
+    if streamed:
+        response.response = compress_stream(response.response, response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress_body(response.get_data(), encoding))
+    response.content_encoding = encoding
+    # тело побайтно отличается от несжатого, поэтому ETag становится слабым
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(collect_metrics()), mimetype='text/plain; version=0.0.4')
+
+@app.context_processor
+def inject_globals():
+    return {'colors': COLORS, 'status_labels': STATUS_LABELS, 'weekday_labels': WEEKDAY_LABELS}
+
+# Статика: файлы static/*.css и *.js отдаются по адресам с хешем содержимого
+# (/assets/app.<хеш>.css) и кэшируются браузером насовсем; сжатые gzip и brotli
+# варианты готовятся один раз при загрузке приложения.
+ASSET_MIMETYPES = {'.css': 'text/css', '.js': 'application/javascript'}
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def load_assets():
+    """{имя файла: (имя с хешем, mimetype, {кодировка: тело})} для static/."""
+    assets = {}
+    for name in sorted(os.listdir(app.static_folder)):
+        stem, ext = os.path.splitext(name)
+        if ext not in ASSET_MIMETYPES:
+            continue
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            body = f.read()
+        bodies = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli:
+            bodies['br'] = brotli.compress(body, quality=11)
+        assets[name] = (f'{stem}.{hashlib.sha1(body).hexdigest()[:12]}{ext}', ASSET_MIMETYPES[ext], bodies)
+    return assets
+
+assets = load_assets()
+asset_names = {hashed: name for name, (hashed, _, _) in assets.items()}
+
+@app.template_global()
+def asset_url(name):
+    return f'/assets/{assets[name][0]}'
+
+def accepted_encoding(available):
+    # лучшая из available, которую принимает клиент; иначе без сжатия
+    for encoding in ('br', 'gzip'):
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return 'identity'
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    name = asset_names.get(filename)
+    if name is None:
+        return "Файл не найден", 404
+    _, mimetype, bodies = assets[name]
+    encoding = accepted_encoding(bodies)
+    response = Response(bodies[encoding], mimetype=mimetype)
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    # адрес меняется вместе с содержимым, поэтому перепроверять копию не нужно
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@app.template_filter('ru_date')
+def ru_date(value):
+    # даты хранятся как YYYY-MM-DD, перестановка частей дешевле strptime/strftime
+    return f'{value[8:10]}.{value[5:7]}.{value[:4]}'
 
 @app.route('/')
+@conditional_page
+@cached_page
 def index():
-    conn = get_db()
+    machines = list(get_lookups()['machines'].items())
+    return render_template('index.html', machines=machines)
+
+# Живое обновление страниц (SSE). Один поток на воркер раз в CHANGES_POLL_INTERVAL
+# сверяет PRAGMA data_version и только после чужой записи читает новые строки
+# record_changes в общий буфер; потоки /events ждут на условии и в базу не ходят.
+# Каждый открытый поток держит поток сервера: gunicorn запускается с
+# --worker-class gthread --threads N (см. Procfile) или gevent, а не синхронными
+# воркерами; --threads ограничивает число одновременно открытых экранов на воркер.
+CHANGES_BUFFER_SIZE = 1000
+SSE_HEARTBEAT = 15
+
+# буфер событий [(id, action, record_id, machine_id, date)] и их id для bisect;
+# буфер полон начиная с id > change_buffer_start
+change_ids = []
+change_events = []
+change_buffer_start = 0
+change_last_id = 0
+change_condition = threading.Condition()
+change_poller = None
+
+def read_changes(conn, after_id):
+    return conn.execute(
+        'SELECT id, action, record_id, machine_id, date FROM record_changes WHERE id > ? ORDER BY id LIMIT ?',
+        (after_id, CHANGES_BUFFER_SIZE)
+    ).fetchall()
+
+def poll_changes_loop():
+    global change_buffer_start, change_last_id
+    conn = connect_db()
+    data_version = None
+    while True:
+        try:
+            # data_version меняется, только когда запись зафиксировало другое соединение
+            current = conn.execute('PRAGMA data_version').fetchone()[0]
+            if current != data_version:
+                data_version = current
+                while True:
+                    rows = read_changes(conn, change_last_id)
+                    if not rows:
+                        break
+                    with change_condition:
+                        change_ids.extend(row[0] for row in rows)
+                        change_events.extend(rows)
+                        if len(change_ids) > CHANGES_BUFFER_SIZE:
+                            del change_ids[:-CHANGES_BUFFER_SIZE]
+                            del change_events[:-CHANGES_BUFFER_SIZE]
+                            change_buffer_start = change_ids[0] - 1
+                        change_last_id = rows[-1][0]
+                        change_condition.notify_all()
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения ленты изменений: {e}")
+        time.sleep(app.config['CHANGES_POLL_INTERVAL'])
+
+def start_change_poller():
+    # поток запускается в самом воркере, после fork
+    global change_poller, change_buffer_start, change_last_id
+    with change_condition:
+        if change_poller is None:
+            change_last_id = change_buffer_start = get_last_change_id()
+            change_poller = threading.Thread(target=poll_changes_loop, name='changes', daemon=True)
+            change_poller.start()
+
+def changes_after(last_id):
+    """События после last_id; None, если часть уже удалена из ленты и нужна перезагрузка."""
+    with change_condition:
+        if last_id >= change_buffer_start:
+            return change_events[bisect.bisect_right(change_ids, last_id):]
+    # клиент отстал сильнее, чем помнит буфер: дочитывается из базы
+    conn = connect_db()
     try:
-        machines = conn.execute('SELECT * FROM machines').fetchall()
+        oldest = conn.execute('SELECT MIN(id) FROM record_changes').fetchone()[0]
+        if oldest is None or last_id < oldest - 1:
+            return None
+        return read_changes(conn, last_id)
     finally:
         conn.close()
-    return render_base(f'''
-        <div class="card">
-            <h1>Учёт работы спецтехники</h1>
-            <table>
-                <tr><th>Техника</th><th>Действия</th></tr>
-                {''.join(f'''
-                <tr>
-                    <td>{row[1]}</td>
-                    <td><a class="btn" href="/calendar/{row[0]}">Календарь</a></td>
-                </tr>
-                ''' for row in machines)}
-            </table>
-        </div>
-    ''')
+
+def stream_changes(last_id, machine_id=None):
+    deadline = time.monotonic() + app.config['SSE_STREAM_SECONDS']
+    # после закрытия потока браузер переподключится сам и пришлёт Last-Event-ID
+    yield 'retry: 3000\n\n'
+    while time.monotonic() < deadline:
+        events = changes_after(last_id)
+        if events is None:
+            yield 'event: reset\ndata: {}\n\n'
+            return
+        if not events:
+            with change_condition:
+                change_condition.wait_for(lambda: change_last_id > last_id,
+                                          min(SSE_HEARTBEAT, max(0, deadline - time.monotonic())))
+            if change_last_id <= last_id:
+                yield ': ping\n\n'
+            continue
+        chunks = []
+        for id, action, record_id, change_machine_id, date in events:
+            if machine_id is None or action == 'reset' or change_machine_id in (machine_id, None):
+                data = json.dumps({'record_id': record_id, 'machine_id': change_machine_id, 'date': date})
+                chunks.append(f'id: {id}\nevent: {action}\ndata: {data}\n\n')
+        last_id = events[-1][0]
+        # событие из одного id без данных только сдвигает Last-Event-ID у клиента,
+        # чтобы после переподключения не получать заново отфильтрованное
+        yield ''.join(chunks) or f'id: {last_id}\n\n'
+
+@app.route('/events')
+def events():
+    """Поток изменений записей (text/event-stream): add, delete и reset.
+
+    Продолжается после Last-Event-ID (браузер шлёт его при переподключении) или
+    last_id из адреса; machine_id оставляет только события одной техники.
+    """
+    start_change_poller()
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id', '')
+    last_id = int(last_id) if last_id.isdigit() else change_last_id
+    machine_id = request.args.get('machine_id', '')
+    machine_id = int(machine_id) if machine_id.isdigit() else None
+    return Response(stream_changes(last_id, machine_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def calendar_days(conn, machine_id, first_day, last_day):
+    """[(день, [(водитель, статус, начало, конец, контрагент)])] за дни [first_day, last_day]."""
+    # один запрос на весь период вместо запроса на каждый день
+    period = (first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d'))
+    hidden, hidden_params = hidden_records_where()
+    rows = select_records(
+        conn, 'r.id, r.date, r.driver_id, r.status, r.start_time, r.end_time, r.counterparty_id',
+        ['r.machine_id = ?', 'r.date BETWEEN ? AND ?'] + hidden, [machine_id, *period] + hidden_params,
+        'date, id', years=archived_years(conn, *period)
+    ).fetchall()
+
+    lookups = get_lookups()
+    drivers = lookups['drivers']
+    counterparties = lookups['counterparties']
+    records = {}
+    for _, date, driver_id, status, start_time, end_time, counterparty_id in rows:
+        records.setdefault(date, []).append(
+            (drivers.get(driver_id), status, start_time, end_time, counterparties.get(counterparty_id))
+        )
+    dates = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+    return [(d, records.get(d.strftime('%Y-%m-%d'), [])) for d in dates]
+
+# годы, которые открывают календарь и табель: за краями datetime(1, 1, 1) и
+# datetime(9999, 12, 31) соседние месяцы и периоды вызывают OverflowError
+CALENDAR_YEARS = range(1900, 2101)
 
 @app.route('/calendar/<int:machine_id>')
+@conditional_page
+@cached_page
 def calendar(machine_id):
-    conn = get_db()
+    today = datetime.now()
     try:
-        machine = conn.execute('SELECT * FROM machines WHERE id = ?', (machine_id,)).fetchone()
-        today = datetime.now()
-        first_day = today.replace(day=1)
-        last_day = (today.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
-        dates = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
-
-        records = {}
-        for d in dates:
-            day_records = conn.execute('''
-                SELECT drivers.name, status, start_time, end_time, counterparties.name
-                FROM records
-                JOIN drivers ON records.driver_id = drivers.id
-                LEFT JOIN counterparties ON records.counterparty_id = counterparties.id
-                WHERE machine_id = ? AND date = ?
-            ''', (machine_id, d.date())).fetchall()
-            records[d.date()] = day_records
-    finally:
-        conn.close()
+        year = int(request.args.get('year', today.year))
+        month = int(request.args.get('month', today.month))
+        if year not in CALENDAR_YEARS:
+            raise ValueError(year)
+        first_day = datetime(year, month, 1)
+    except ValueError:
+        return redirect(f'/calendar/{machine_id}')
+    last_day = (first_day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+    lookups = get_lookups()
+    if machine_id not in lookups['machines']:
+        return "Техника не найдена", 404
+    machine = (machine_id, lookups['machines'][machine_id])
 
-    calendar_html = '<div class="calendar-grid">'
-    for d in dates:
-        day_records = records.get(d.date(), [])
-        calendar_html += f'''
-        <div class="calendar-day">
-            <div style="font-weight: bold; margin-bottom: 0.5rem;">{d.strftime("%d.%m")}</div>
-            {''.join(f'''
-            <div class="status" style="background: {COLORS['status'].get(r[1], '#ffffff')}">
-                {r[0]} - {r[1].capitalize()}<br>
-                {f"{r[2]}-{r[3]}" if r[2] and r[3] else ""}<br>
-                {r[4] if r[4] else ""}
-            </div>
-            ''' for r in day_records)}
-        </div>'''
-    calendar_html += '</div>'
-
-    return render_base(f'''
-        <a href="/" class="btn back-btn">← Назад</a>
-        <div class="card">
-            <h1>{machine[1]} - {today.strftime("%B %Y")}</h1>
-            {calendar_html}
-        </div>
-    ''')
+    prev_month = first_day - timedelta(days=1)
+    next_month = last_day + timedelta(days=1)
+
+    return render_template(
+        'calendar.html',
+        machine=machine,
+        first_day=first_day,
+        prev_month=prev_month,
+        next_month=next_month,
+        days=calendar_days(get_db(), machine_id, first_day, last_day),
+        last_change_id=get_last_change_id()
+    )
+
+@app.route('/calendar/<int:machine_id>/days')
+@cached_page
+def calendar_day_cells(machine_id):
+    """Ячейки календаря за date_from..date_to (не больше месяца) для живого обновления."""
+    try:
+        first_day = datetime.strptime(request.args.get('date_from', ''), '%Y-%m-%d')
+        last_day = datetime.strptime(request.args.get('date_to', ''), '%Y-%m-%d')
+    except ValueError:
+        return "Нужны date_from и date_to", 400
+    if first_day.year not in CALENDAR_YEARS:
+        return "Год вне диапазона", 400
+    last_day = min(last_day, first_day + timedelta(days=30))
+    return render_template('calendar_days.html', days=calendar_days(get_db(), machine_id, first_day, last_day))
+
+def deleted_driver_totals(conn, date_from=None, date_to=None, machine_id=None, monthly=False):
+    """{(техника, день или месяц, статус): [записей, часов]} по записям удалённых водителей.
+
+    В итогах по технике (daily_machine_stats, monthly_machine_stats) водителя нет,
+    поэтому записи водителей, ждущих фоновой очистки, из них вычитаются по этим суммам.
+    """
+    deleted = load_lookups(conn)[2]['drivers']
+    totals = {}
+    if not deleted:
+        return totals
+    where = [f"r.driver_id IN ({','.join('?' * len(deleted))})"]
+    params = list(deleted)
+    for condition, value in (('r.machine_id = ?', machine_id), ('r.date >= ?', date_from), ('r.date <= ?', date_to)):
+        if value is not None:
+            where.append(condition)
+            params.append(value)
+    for machine, date, status, hours in select_records(
+            conn, 'r.machine_id, r.date, r.status, COALESCE(r.hours, 0)', where, params, None,
+            years=archived_years(conn, date_from, date_to)):
+        counts = totals.setdefault((machine, date[:7] if monthly else date, status), [0, 0])
+        counts[0] += 1
+        counts[1] += hours
+    return totals
+
+BOARD_MAX_DAYS = 92
+# цвет ячейки при нескольких записях за день: ремонт и простой важнее работы
+BOARD_STATUS_RANK = {status: rank for rank, status in enumerate(('repair', 'stop', 'work', 'holiday'))}
+
+@app.route('/board')
+@conditional_page
+@cached_page
+def board():
+    today = datetime.now()
+    month_start = today.replace(day=1)
+    month_end = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    try:
+        date_from = datetime.strptime(request.args.get('date_from') or month_start.strftime('%Y-%m-%d'), '%Y-%m-%d')
+        date_to = datetime.strptime(request.args.get('date_to') or month_end.strftime('%Y-%m-%d'), '%Y-%m-%d')
+    except ValueError:
+        return redirect('/board')
+    if date_from.year not in CALENDAR_YEARS or date_to.year not in CALENDAR_YEARS:
+        return redirect('/board')
+    if date_to < date_from:
+        date_from, date_to = date_to, date_from
+    date_to = min(date_to, date_from + timedelta(days=BOARD_MAX_DAYS - 1))
+    dates = [date_from + timedelta(days=i) for i in range((date_to - date_from).days + 1)]
+    day_index = {d.strftime('%Y-%m-%d'): i for i, d in enumerate(dates)}
+
+    machines = get_lookups()['machines']
+    conn = get_db()
+    period = (date_from.strftime('%Y-%m-%d'), date_to.strftime('%Y-%m-%d'))
+    # один запрос по готовым дневным итогам вместо календаря на каждую машину
+    stats = conn.execute('''
+        SELECT machine_id, date, status, record_count, hours
+        FROM daily_machine_stats
+        WHERE date BETWEEN ? AND ?
+    ''', period).fetchall()
+    # записи удалённых водителей, ещё не вычищенные очисткой, в итогах не показываются
+    hidden = deleted_driver_totals(conn, *period)
+    if hidden:
+        stats = [
+            (machine_id, date, status, record_count - hidden_count, hours - hidden_hours)
+            for machine_id, date, status, record_count, hours in stats
+            for hidden_count, hidden_hours in [hidden.get((machine_id, date, status), (0, 0))]
+            if record_count > hidden_count
+        ]
+
+    # {machine_id: [None | [статус для цвета, часы, {статус: часы} -> подсказка] по дням]}
+    cells = {}
+    day_totals = [0] * len(dates)
+    for machine_id, date, status, _, hours in stats:
+        if machine_id not in machines:
+            # удалённая техника, чьи итоги ещё не вычистила фоновая очистка
+            continue
+        i = day_index[date]
+        row = cells.setdefault(machine_id, [None] * len(dates))
+        cell = row[i]
+        if cell is None:
+            cell = row[i] = [status, 0, {}]
+        elif BOARD_STATUS_RANK.get(status, len(BOARD_STATUS_RANK)) < BOARD_STATUS_RANK.get(cell[0], len(BOARD_STATUS_RANK)):
+            cell[0] = status
+        cell[1] += hours
+        cell[2][status] = hours
+        day_totals[i] += hours
+
+    empty = [None] * len(dates)
+    rows = []
+    for machine_id, name in machines.items():
+        row = cells.get(machine_id, empty)
+        for cell in row:
+            # подсказка нужна только ячейкам с несколькими статусами за день
+            if cell and len(cell[2]) > 1:
+                cell[2] = ', '.join(f'{STATUS_LABELS.get(status, status)} {hours} ч' for status, hours in cell[2].items())
+            elif cell:
+                cell[2] = ''
+        rows.append((machine_id, name, row, sum(cell[1] for cell in row if cell)))
+
+    span = timedelta(days=len(dates))
+    return render_template(
+        'board.html',
+        dates=dates,
+        rows=rows,
+        day_totals=day_totals,
+        total=sum(day_totals),
+        date_from=date_from,
+        date_to=date_to,
+        prev_from=date_from - span,
+        prev_to=date_from - timedelta(days=1),
+        next_from=date_to + timedelta(days=1),
+        next_to=date_to + span,
+        max_days=BOARD_MAX_DAYS
+    )
 
 @app.route('/admin')
 def admin():
-    return render_base('''
-        <div class="card">
-            <h1>Административная панель</h1>
-            <div style="display: grid; grid-template-columns: repeat(3, 1fr); gap: 1rem;">
-                <a class="btn" href="/admin/machines"> Управление техникой</a>
-                <a class="btn" href="/admin/drivers"> Управление водителями</a>
-                <a class="btn" href="/admin/counterparties"> Управление контрагентами</a>
-                <a class="btn" href="/admin/records"> Управление записями</a>
-            </div>
-        </div>
-    ''')
+    return render_template('admin.html')
 
 @app.route('/admin/machines', methods=['GET', 'POST'])
+@conditional_page
+@cached_page
 def admin_machines():
     if request.method == 'POST':
         name = request.form['name']
         conn = get_db()
         try:
             conn.execute('INSERT INTO machines (name) VALUES (?)', (name,))
+            bump_data_version(conn)
+            bump_lookup_version(conn)
             conn.commit()
         except sqlite3.IntegrityError:
             pass
-        finally:
-            conn.close()
         return redirect('/admin/machines')
     
-    conn = get_db()
-    try:
-        machines = conn.execute('SELECT * FROM machines').fetchall()
-    finally:
-        conn.close()
+    machines = list(get_lookups()['machines'].items())
     
-    return render_base(f'''
-        <a href="/admin" class="btn back-btn">← Назад</a>
-        <div class="card">
-            <h1>Управление техникой</h1>
-            <form method="POST">
-                <input type="text" name="name" placeholder="Название техники" required>
-                <button type="submit" class="btn">Добавить</button>
-            </form>
-            <table>
-                <tr><th>ID</th><th>Название</th><th>Действия</th></tr>
-                {''.join(f'''
-                <tr>
-                    <td>{row[0]}</td>
-                    <td>{row[1]}</td>
-                    <td>
-                        <form method="POST" action="/delete/machine/{row[0]}">
-                            <button type="submit" class="btn btn-danger" 
-                                onclick="return confirmDelete('Удалить машину {row[1]}?')">
-                                Удалить
-                            </button>
-                        </form>
-                    </td>
-                </tr>
-                ''' for row in machines)}
-            </table>
-        </div>
-    ''')
+    return render_template(
+        'admin_list.html',
+        rows=machines,
+        kind='machine',
+        title='Управление техникой',
+        placeholder='Название техники',
+        name_header='Название',
+        confirm_text='Удалить машину',
+        pending=len(load_lookups()[2]['machines'])
+    )
 
 @app.route('/admin/drivers', methods=['GET', 'POST'])
+@conditional_page
+@cached_page
 def admin_drivers():
     if request.method == 'POST':
         name = request.form['name']
         conn = get_db()
         try:
             conn.execute('INSERT INTO drivers (name) VALUES (?)', (name,))
+            bump_data_version(conn)
+            bump_lookup_version(conn)
             conn.commit()
         except sqlite3.IntegrityError as e:
             print(f"Ошибка добавления водителя: {e}")
-        finally:
-            conn.close()
         return redirect('/admin/drivers')
     
-    conn = get_db()
-    try:
-        drivers = conn.execute('SELECT * FROM drivers').fetchall()
-    finally:
-        conn.close()
+    drivers = list(get_lookups()['drivers'].items())
     
-    return render_base(f'''
-        <a href="/admin" class="btn back-btn">← Назад</a>
-        <div class="card">
-            <h1>Управление водителями</h1>
-            <form method="POST">
-                <input type="text" name="name" placeholder="ФИО водителя" required>
-                <button type="submit" class="btn">Добавить</button>
-            </form>
-            <table>
-                <tr><th>ID</th><th>Имя</th><th>Действия</th></tr>
-                {''.join(f'''
-                <tr>
-                    <td>{row[0]}</td>
-                    <td>{row[1]}</td>
-                    <td>
-                        <form method="POST" action="/delete/driver/{row[0]}">
-                            <button type="submit" class="btn btn-danger"
-                                onclick="return confirmDelete('Удалить водителя {row[1]}?')">
-                                Удалить
-                            </button>
-                        </form>
-                    </td>
-                </tr>
-                ''' for row in drivers)}
-            </table>
-        </div>
-    ''')
+    return render_template(
+        'admin_list.html',
+        rows=drivers,
+        kind='driver',
+        title='Управление водителями',
+        placeholder='ФИО водителя',
+        name_header='Имя',
+        confirm_text='Удалить водителя',
+        pending=len(load_lookups()[2]['drivers'])
+    )
 
 @app.route('/admin/counterparties', methods=['GET', 'POST'])
+@conditional_page
+@cached_page
 def admin_counterparties():
     if request.method == 'POST':
         name = request.form['name']
         conn = get_db()
         try:
             conn.execute('INSERT INTO counterparties (name) VALUES (?)', (name,))
+            bump_data_version(conn)
+            bump_lookup_version(conn)
             conn.commit()
         except sqlite3.IntegrityError as e:
             print(f"Ошибка добавления контрагента: {e}")
-        finally:
-            conn.close()
         return redirect('/admin/counterparties')
     
-    conn = get_db()
+    counterparties = list(get_lookups()['counterparties'].items())
+    
+    return render_template(
+        'admin_list.html',
+        rows=counterparties,
+        kind='counterparty',
+        title='Управление контрагентами',
+        placeholder='Название контрагента',
+        name_header='Название',
+        confirm_text='Удалить контрагента',
+        pending=len(load_lookups()[2]['counterparties'])
+    )
+
+def calc_hours(start_time, end_time):
+    # полные часы между началом и концом смены; конец раньше начала — смена через полночь
+    start = datetime.strptime(start_time, '%H:%M')
+    end = datetime.strptime(end_time, '%H:%M')
+    if end < start:
+        end += timedelta(days=1)
+    delta = end - start
+    return delta.seconds // 3600
+
+# смена короче суток, поэтому пересекающаяся начинается не раньше чем за сутки до начала новой
+OVERLAP_WINDOW = 1440
+OVERLAP_KEYS = (('machine_id', 'machines', 'Техника'), ('driver_id', 'drivers', 'Водитель'))
+
+def find_overlaps(conn, first_id):
+    """Пересечения по времени записей с id >= first_id (только что вставленных).
+
+    Возвращает [(ключ, значение ключа, id, date, start_time, end_time, из тех же новых)]
+    — записи той же техники или того же водителя, с которыми пересеклись новые.
+    Ищется по индексам (ключ, start_at, end_at) в окне одних суток, поэтому
+    видны и ночные смены накануне; пара новых записей попадает в ответ один раз.
+    """
+    # записи, ждущие фоновой очистки, уже не мешают новым
+    hidden, hidden_params = hidden_records_where(conn, 'o')
+    hidden_sql = ''.join(f' AND {condition}' for condition in hidden)
+    sql = ' UNION ALL '.join(f'''
+        SELECT '{key}', n.{key}, o.id, o.date, o.start_time, o.end_time, o.id >= ?
+        FROM records n JOIN records o ON o.{key} = n.{key} AND o.id < n.id
+            AND o.start_at > n.start_at - {OVERLAP_WINDOW} AND o.start_at < n.end_at AND o.end_at > n.start_at{hidden_sql}
+        WHERE n.id >= ? AND n.start_at IS NOT NULL''' for key, _, _ in OVERLAP_KEYS)
+    return conn.execute(sql, [first_id, *hidden_params, first_id] * len(OVERLAP_KEYS)).fetchall()
+
+def describe_overlaps(overlaps, limit=20):
+    # строки для ответа пользователю, повторы схлопываются
+    tables = {key: table for key, table, _ in OVERLAP_KEYS}
+    lookups = get_lookups()
+    lines = list(dict.fromkeys(
+        f"{lookups[tables[key]].get(value, value)} {ru_date(date)} {start}-{end} "
+        + ('(в этом же вводе)' if new else f'(№{id})')
+        for key, value, id, date, start, end, new in overlaps
+    ))
+    if len(lines) > limit:
+        lines = lines[:limit] + [f'и ещё {len(lines) - limit}']
+    return lines
+
+def sweep_overlaps(rows):
+    """Пересечения в строках (ключ, id, start_at, end_at), упорядоченных по (ключ, start_at).
+
+    Один проход: в куче лежат смены ключа, ещё не закончившиеся к началу
+    текущей; каждая из них пересекается с текущей. Возвращает [(ключ, id, id)].
+    """
+    overlaps = []
+    active = []
+    current = None
+    for key, id, start_at, end_at in rows:
+        if key != current:
+            current = key
+            active = []
+        while active and active[0][0] <= start_at:
+            heapq.heappop(active)
+        overlaps.extend((key, other, id) for _, other in active)
+        heapq.heappush(active, (end_at, id))
+    return overlaps
+
+@app.cli.command('check-overlaps')
+@click.option('--limit', default=50, show_default=True, help='Сколько пересечений вывести по каждому ключу.')
+def check_overlaps_command(limit):
+    """Ищет пересечения смен по технике и водителям во всей records; код выхода 1, если есть."""
+    conn = connect_db()
     try:
-        counterparties = conn.execute('SELECT * FROM counterparties').fetchall()
+        lookups = get_lookups(conn)
+        found = False
+        for key, table, label in OVERLAP_KEYS:
+            rows = conn.execute(f'''
+                SELECT {key}, id, start_at, end_at FROM records
+                WHERE start_at IS NOT NULL ORDER BY {key}, start_at
+            ''')
+            overlaps = sweep_overlaps(rows)
+            click.echo(f"{label}: {'OK' if not overlaps else f'пересечений {len(overlaps)}'}")
+            if not overlaps:
+                continue
+            found = True
+            ids = sorted({id for overlap in overlaps[:limit] for id in overlap[1:]})
+            details = {row[0]: row[1:] for row in conn.execute(
+                f"SELECT id, date, start_time, end_time FROM records WHERE id IN ({','.join('?' * len(ids))})", ids)}
+            for value, first, second in overlaps[:limit]:
+                click.echo(f"  {lookups[table].get(value, value)}: " + ' и '.join(
+                    f'#{id} {details[id][0]} {details[id][1]}-{details[id][2]}' for id in (first, second)))
     finally:
         conn.close()
-    
-    return render_base(f'''
-        <a href="/admin" class="btn back-btn">← Назад</a>
-        <div class="card">
-            <h1>Управление контрагентами</h1>
-            <form method="POST">
-                <input type="text" name="name" placeholder="Название контрагента" required>
-                <button type="submit" class="btn">Добавить</button>
-            </form>
-            <table>
-                <tr><th>ID</th><th>Название</th><th>Действия</th></tr>
-                {''.join(f'''
-                <tr>
-                    <td>{row[0]}</td>
-                    <td>{row[1]}</td>
-                    <td>
-                        <form method="POST" action="/delete/counterparty/{row[0]}">
-                            <button type="submit" class="btn btn-danger"
-                                onclick="return confirmDelete('Удалить контрагента {row[1]}?')">
-                                Удалить
-                            </button>
-                        </form>
-                    </td>
-                </tr>
-                ''' for row in counterparties)}
-            </table>
-        </div>
-    ''')
+    if found:
+        raise SystemExit(1)
+
+RECORDS_PAGE_SIZE = 100
+RECORDS_PAGE_SIZES = (50, 100, 200, 500)
+
+def parse_record_filters(args, conn=None):
+    """Разбирает фильтры списка записей из query-строки.
+
+    Возвращает принятые значения фильтров (для ссылок и формы) и готовые
+    условия WHERE с параметрами для запроса по records r; записи удалённых
+    техники и водителей исключаются всегда.
+    """
+    filters = {}
+    where, params = hidden_records_where(conn)
+    for key in ('machine_id', 'driver_id', 'counterparty_id'):
+        value = args.get(key, '')
+        if value.isdigit():
+            filters[key] = value
+            where.append(f'r.{key} = ?')
+            params.append(int(value))
+    status = args.get('status', '')
+    if status in STATUS_LABELS:
+        filters['status'] = status
+        where.append('r.status = ?')
+        params.append(status)
+    for key, op in (('date_from', '>='), ('date_to', '<=')):
+        value = args.get(key, '')
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            continue
+        filters[key] = value
+        where.append(f'r.date {op} ?')
+        params.append(value)
+    return filters, where, params
+
+def parse_record_cursor(value):
+    # курсор страницы записей: '<date>_<id>' крайней строки
+    try:
+        cursor_date, cursor_id = value.rsplit('_', 1)
+        return datetime.strptime(cursor_date, '%Y-%m-%d').strftime('%Y-%m-%d'), int(cursor_id)
+    except ValueError:
+        return None
+
+# Пакетный ввод: каждый день периода (с маской дней недели) × техника × водители,
+# например месячный ремонт нескольких единиц техники одним запросом
+RECORD_BATCH_MAX_DAYS = 366
+RECORD_BATCH_MAX_ROWS = 5000
+WEEKDAY_LABELS = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+
+def expand_record_batch(values):
+    """Строки для INSERT из полей формы /admin/records или JSON: {поле: [значения]}.
+
+    date — день или начало периода, date_to — его конец, weekdays — номера дней
+    недели (0 — понедельник, пусто — все), machine_id и driver_id — ID; несколько
+    можно указать только с одной стороны: несколько машин с одним водителем или
+    один водитель на нескольких машинах, но не все пары сразу; counterparty_id —
+    не больше одного. Ошибки ввода, в том числе маска дней недели без единого
+    дня в периоде, — ValueError с текстом для пользователя, до любой записи в базу.
+    """
+    def first(key):
+        items = values.get(key) or [None]
+        return '' if items[0] is None else str(items[0]).strip()
+
+    def number(value):
+        # из JSON приходят и числа, и строки; true (== 1) и дробные числа не принимаются
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError(value)
+        return int(value)
+
+    def id_list(key, table, label):
+        try:
+            ids = list(dict.fromkeys(number(value) for value in values.get(key, []) if str(value).strip()))
+        except ValueError:
+            raise ValueError(f'{label}: нужны числовые ID')
+        unknown = [id for id in ids if id not in lookups[table]]
+        if unknown:
+            raise ValueError(f'{label}: нет ID {", ".join(map(str, unknown))}')
+        return ids
+
+    lookups = get_lookups()
+    try:
+        date_from = datetime.strptime(first('date'), '%Y-%m-%d')
+        date_to = datetime.strptime(first('date_to'), '%Y-%m-%d') if first('date_to') else date_from
+    except ValueError:
+        raise ValueError('даты нужны в формате ГГГГ-ММ-ДД')
+    if date_to < date_from:
+        raise ValueError('конец периода раньше начала')
+    if (date_to - date_from).days >= RECORD_BATCH_MAX_DAYS:
+        raise ValueError(f'период длиннее {RECORD_BATCH_MAX_DAYS} дней')
+    try:
+        weekdays = {number(value) for value in values.get('weekdays', []) if str(value).strip()} or set(range(7))
+    except ValueError:
+        raise ValueError('дни недели — числа от 0 до 6')
+    if not weekdays <= set(range(7)):
+        raise ValueError('дни недели — числа от 0 до 6')
+
+    machine_ids = id_list('machine_id', 'machines', 'Техника')
+    driver_ids = id_list('driver_id', 'drivers', 'Водитель')
+    if not machine_ids or not driver_ids:
+        raise ValueError('не указаны техника или водитель')
+    if len(machine_ids) > 1 and len(driver_ids) > 1:
+        # все пары «техника × водитель» — это одновременные смены одних и тех же людей
+        raise ValueError('несколько можно выбрать либо техники, либо водителей, но не то и другое сразу')
+    counterparty_id = id_list('counterparty_id', 'counterparties', 'Контрагент') or [None]
+    if len(counterparty_id) > 1:
+        raise ValueError('Контрагент: можно указать только один')
+    status = first('status')
+    if status not in STATUS_LABELS:
+        raise ValueError(f"неизвестный статус '{status}'")
+    start_time = import_time(first('start_time'))
+    end_time = import_time(first('end_time'))
+    hours = calc_hours(start_time, end_time) if start_time and end_time else 0
+
+    days = [date_from + timedelta(days=n) for n in range((date_to - date_from).days + 1)]
+    days = [day.strftime('%Y-%m-%d') for day in days if day.weekday() in weekdays]
+    if not days:
+        raise ValueError('в периоде нет дней, подходящих под выбранные дни недели')
+    if len(days) * len(machine_ids) * len(driver_ids) > RECORD_BATCH_MAX_ROWS:
+        raise ValueError(f'больше {RECORD_BATCH_MAX_ROWS} записей за раз')
+    return [
+        (day, machine_id, driver_id, status, start_time or None, end_time or None,
+         hours, first('comment'), counterparty_id[0])
+        for day in days for machine_id in machine_ids for driver_id in driver_ids
+    ]
+
+def insert_record_batch(conn, rows):
+    """Вставляет строки одним executemany в одной транзакции.
+
+    Если новые смены пересекаются между собой или с уже внесёнными, транзакция
+    откатывается и возвращаются пересечения (find_overlaps), иначе [].
+    """
+    conn.executemany('''
+        INSERT INTO records
+        (date, machine_id, driver_id, status, start_time, end_time, hours, comment, counterparty_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    # id из AUTOINCREMENT в одной транзакции идут подряд
+    last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    first_id = last_id - len(rows) + 1
+    overlaps = find_overlaps(conn, first_id) if rows else []
+    if overlaps:
+        conn.rollback()
+        return overlaps
+    log_changes(conn, 'add', [(first_id + n, row[1], row[0]) for n, row in enumerate(rows)])
+    bump_data_version(conn)
+    conn.commit()
+    return []
+
+RECORD_TABLE_COLUMNS = '''r.id, r.date, r.machine_id, r.driver_id, r.start_time, r.end_time,
+                          r.hours, r.comment, r.counterparty_id, r.status'''
+
+def record_table_rows(rows):
+    # имена подставляются из кэша справочников вместо JOIN
+    lookups = get_lookups()
+    machines, drivers, counterparties = (lookups[table] for table in LOOKUP_TABLES)
+    return [
+        (r[0], r[1], machines.get(r[2]), drivers.get(r[3]), r[4], r[5], r[6], r[7], counterparties.get(r[8]), r[9])
+        for r in rows
+    ]
 
 @app.route('/admin/records', methods=['GET', 'POST'])
+@conditional_page
 def admin_records():
     if request.method == 'POST':
         conn = get_db()
         try:
-            date_str = request.form['date']
-            machine_id = int(request.form['machine_id'])
-            driver_id = int(request.form['driver_id'])
-            status = request.form['status']
-            start_time = request.form.get('start_time', '')
-            end_time = request.form.get('end_time', '')
-            comment = request.form.get('comment', '')
-
-            counterparty_id = request.form.get('counterparty_id')
-            if counterparty_id:
-                counterparty_id = int(counterparty_id)
-            else:
-                counterparty_id = None
-
-            hours = 0
-            if start_time and end_time:
-                try:
-                    start = datetime.strptime(start_time, '%H:%M')
-                    end = datetime.strptime(end_time, '%H:%M')
-                    if end < start:
-                        end += timedelta(days=1)
-                    delta = end - start
-                    hours = delta.seconds // 3600
-                except ValueError as e:
-                    print(f"Ошибка расчета времени: {e}")
-
-            conn.execute('''
-                INSERT INTO records
-                (date, machine_id, driver_id, status, start_time, end_time, hours, comment, counterparty_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                date_str,
-                machine_id,
-                driver_id,
-                status,
-                start_time or None,
-                end_time or None,
-                hours,
-                comment,
-                counterparty_id
-            ))
-            conn.commit()
+            rows = expand_record_batch({key: request.form.getlist(key) for key in request.form})
+            overlaps = insert_record_batch(conn, rows)
+            if overlaps:
+                return "Пересечение по времени с записями: " + '; '.join(describe_overlaps(overlaps)), 409
+        except ValueError as e:
+            return f"Ошибка: {e}", 400
         except Exception as e:
             print(f"Ошибка создания записи: {e}")
             conn.rollback()
-        finally:
-            conn.close()
         return redirect('/admin/records')
 
-    conn = get_db()
+    filters, where, params = parse_record_filters(request.args)
     try:
-        records = conn.execute('''
-            SELECT r.id, r.date, m.name, d.name, r.start_time, r.end_time,
-                   r.hours, r.comment, c.name, r.status
-            FROM records r
-            JOIN machines m ON r.machine_id = m.id
-            JOIN drivers d ON r.driver_id = d.id
-            LEFT JOIN counterparties c ON r.counterparty_id = c.id
-            ORDER BY r.date DESC
-        ''').fetchall()
-
-        machines = conn.execute('SELECT * FROM machines').fetchall()
-        drivers = conn.execute('SELECT * FROM drivers').fetchall()
-        counterparties = conn.execute('SELECT * FROM counterparties').fetchall()
-    finally:
-        conn.close()
+        per_page = int(request.args.get('per_page', RECORDS_PAGE_SIZE))
+    except ValueError:
+        per_page = RECORDS_PAGE_SIZE
+    if per_page not in RECORDS_PAGE_SIZES:
+        per_page = RECORDS_PAGE_SIZE
 
-    return render_base(f'''
-        <a href="/admin" class="btn back-btn">← Назад</a>
-        <div class="card">
-            <h1>Управление записями</h1>
-            <form method="POST">
-                <div style="display: grid; grid-template-columns: repeat(2, 1fr); gap: 1rem;">
-                    <input type="date" name="date" required>
-                    <select name="machine_id" required>
-                        <option value="">Выберите технику</option>
-                        {''.join(f'<option value="{row[0]}">{row[1]}</option>' for row in machines)}
-                    </select>
-                    <select name="driver_id" required>
-                        <option value="">Выберите водителя</option>
-                        {''.join(f'<option value="{row[0]}">{row[1]}</option>' for row in drivers)}
-                    </select>
-                    <select name="status" required>
-                        <option value="work">Работа</option>
-                        <option value="stop">Простой</option>
-                        <option value="repair">Ремонт</option>
-                        <option value="holiday">Выходной</option>
-                    </select>
-                    <input type="time" name="start_time" placeholder="Начало">
-                    <input type="time" name="end_time" placeholder="Конец">
-                    <select name="counterparty_id">
-                        <option value="">Контрагент (не обязательно)</option>
-                        {''.join(f'<option value="{row[0]}">{row[1]}</option>' for row in counterparties)}
-                    </select>
-                    <input type="text" name="comment" placeholder="Комментарий" style="grid-column: span 2;">
-                </div>
-                <button type="submit" class="btn" style="margin-top: 1rem;">Добавить запись</button>
-            </form>
-
-            <table style="margin-top: 2rem;">
-                <tr>
-                    <th>Дата</th>
-                    <th>Техника</th>
-                    <th>Водитель</th>
-                    <th>Время</th>
-                    <th>Часы</th>
-                    <th>Контрагент</th>
-                    <th>Комментарий</th>
-                    <th>Статус</th>
-                    <th>Действия</th>
-                </tr>
-                {''.join(f'''
-                <tr>
-                    <td>{datetime.strptime(row[1], '%Y-%m-%d').strftime('%d.%m.%Y')}</td>
-                    <td>{row[2]}</td>
-                    <td>{row[3]}</td>
-                    <td>{f"{row[4]} - {row[5]}" if row[4] and row[5] else "-"}</td>
-                    <td>{row[6] or "0"}</td>
-                    <td>{row[8] or "-"}</td>
-                    <td>{row[7] or "-"}</td>
-                    <td>
-                        <div class="status" style="background: {COLORS['status'].get(row[9], '#ffffff')}">
-                            {row[9].capitalize()}
-                        </div>
-                    </td>
-                    <td>
-                        <form method="POST" action="/delete/record/{row[0]}">
-                            <button type="submit" class="btn btn-danger" 
-                                onclick="return confirmDelete('Удалить запись?')">
-                                Удалить
-                            </button>
-                        </form>
-                    </td>
-                </tr>
-                ''' for row in records)}
-            </table>
-        </div>
-    ''')
+    # keyset-пагинация по (date DESC, id DESC): after — следующая страница, before — предыдущая
+    cursor = None
+    backwards = False
+    for key in ('after', 'before'):
+        cursor = parse_record_cursor(request.args.get(key, ''))
+        if cursor:
+            backwards = key == 'before'
+            break
+
+    page_where = list(where)
+    page_params = list(params)
+    if cursor:
+        op = '>' if backwards else '<'
+        page_where.append(f'(r.date {op} ? OR (r.date = ? AND r.id {op} ?))')
+        page_params += [cursor[0], cursor[0], cursor[1]]
+    order = 'ASC' if backwards else 'DESC'
 
-@app.route('/delete/machine/<int:id>', methods=['POST'])
-def delete_machine(id):
     conn = get_db()
-    try:
-        conn.execute('DELETE FROM machines WHERE id = ?', (id,))
+    columns = RECORD_TABLE_COLUMNS
+    # архивы подключаются только для лет, которые может задеть страница
+    date_from, date_to = filters.get('date_from'), filters.get('date_to')
+    if backwards:
+        date_from = max(date_from or cursor[0], cursor[0])
+        rows = select_records(conn, columns, page_where, page_params, f'date {order}, id {order}',
+                              per_page + 1, archived_years(conn, date_from, date_to)).fetchall()
+    else:
+        if cursor:
+            date_to = min(date_to or cursor[0], cursor[0])
+        rows = select_recent_records(conn, columns, page_where, page_params, per_page + 1, date_from, date_to)
+
+    records = record_table_rows(rows)
+
+    # лишняя строка сверх per_page показывает, что в этом направлении есть ещё записи
+    has_more = len(records) > per_page
+    records = records[:per_page]
+    if backwards:
+        records.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, cursor is not None
+
+    base_args = dict(filters, per_page=per_page)
+    nav_links = []
+    if has_prev and records:
+        nav_links.append((f'/admin/records?{urlencode(base_args)}', '« В начало'))
+        nav_links.append((f'/admin/records?{urlencode(dict(base_args, before=f"{records[0][1]}_{records[0][0]}"))}', '← Новее'))
+    if has_next and records:
+        nav_links.append((f'/admin/records?{urlencode(dict(base_args, after=f"{records[-1][1]}_{records[-1][0]}"))}', 'Старее →'))
+
+    return render_template(
+        'admin_records.html',
+        records=records,
+        filters=filters,
+        per_page=per_page,
+        page_sizes=RECORDS_PAGE_SIZES,
+        nav_links=nav_links,
+        # новые записи вживую добавляются только на первую страницу
+        live_updates=cursor is None,
+        last_change_id=get_last_change_id()
+    )
+
+@app.route('/admin/records/rows')
+@cached_page
+def admin_record_rows():
+    """Строки таблицы /admin/records для записей ids, подходящих под фильтры страницы."""
+    filters, where, params = parse_record_filters(request.args)
+    ids = [int(value) for value in request.args.get('ids', '').split(',') if value.isdigit()]
+    ids = ids[:RECORDS_PAGE_SIZES[-1]]
+    if not ids:
+        return ''
+    where.append(f"r.id IN ({','.join('?' * len(ids))})")
+    # новые записи лежат в рабочей базе; порядок страницы восстанавливается здесь
+    rows = get_db().execute(f"SELECT {RECORD_TABLE_COLUMNS} FROM records r WHERE {' AND '.join(where)}",
+                            params + ids).fetchall()
+    rows.sort(key=lambda row: (row[1], row[0]), reverse=True)
+    return render_template('record_rows.html', records=record_table_rows(rows))
+
+# Удаление техники, водителя или контрагента — мягкое: строка справочника помечается
+# deleted_at и сразу пропадает со страниц (load_lookups, hidden_records_where), а её
+# записи удаляет фоновая очистка пачками по PURGE_BATCH_SIZE, каждая пачка — своя
+# короткая транзакция. Ход очистки хранится в purges, прерванная очистка продолжается
+# после перезапуска. Если за очистку одновременно взялись два воркера, они просто
+# делят пачки между собой.
+PURGE_KEYS = {'machines': 'machine_id', 'drivers': 'driver_id', 'counterparties': 'counterparty_id'}
+PURGE_LABELS = {'machines': 'Техника', 'drivers': 'Водитель', 'counterparties': 'Контрагент'}
+PURGES_SHOWN = 50
+
+def soft_delete(conn, table, id):
+    """Помечает строку справочника удалённой и ставит её записи в очередь очистки."""
+    row = conn.execute(f'SELECT name FROM {table} WHERE id = ? AND deleted_at IS NULL', (id,)).fetchone()
+    if row is None:
+        return False
+    now = int(time.time())
+    conn.execute(f'UPDATE {table} SET deleted_at = ? WHERE id = ?', (now, id))
+    total = conn.execute(f'SELECT COUNT(*) FROM records WHERE {PURGE_KEYS[table]} = ?', (id,)).fetchone()[0]
+    conn.execute('INSERT OR REPLACE INTO purges (entity, entity_id, name, total, started_at) VALUES (?, ?, ?, ?, ?)',
+                 (table, id, row[0], total, now))
+    log_changes(conn, 'reset')
+    bump_data_version(conn)
+    bump_lookup_version(conn)
+    return True
+
+def purge_entity(conn, table, id, progress=None):
+    """Удаляет записи удалённой строки справочника пачками, затем архивные записи и саму строку.
+
+    Для контрагента ссылка в записях обнуляется. progress(n) вызывается после
+    каждой пачки.
+    """
+    column = PURGE_KEYS[table]
+    if table == 'counterparties':
+        sql = 'UPDATE records SET counterparty_id = NULL WHERE id IN (SELECT id FROM records WHERE counterparty_id = ? LIMIT ?)'
+    else:
+        sql = f'DELETE FROM records WHERE id IN (SELECT id FROM records WHERE {column} = ? LIMIT ?)'
+    while True:
+        changed = conn.execute(sql, (id, app.config['PURGE_BATCH_SIZE'])).rowcount
+        if not changed:
+            break
+        conn.execute('UPDATE purges SET done = done + ? WHERE entity = ? AND entity_id = ?', (changed, table, id))
         conn.commit()
+        if progress:
+            progress(changed)
+        time.sleep(app.config['PURGE_PAUSE'])
+
+    # архивы — отдельные файлы: их запись не держит блокировку рабочей базы
+    delete_from_archives(conn, column, [id])
+    conn.execute(f'DELETE FROM {table} WHERE id = ?', (id,))
+    conn.execute('UPDATE purges SET finished_at = ? WHERE entity = ? AND entity_id = ?', (int(time.time()), table, id))
+    bump_data_version(conn)
+    bump_lookup_version(conn)
+    conn.commit()
+
+def purge_pending(conn, progress=None):
+    # незаконченные очистки по порядку постановки; возвращает их число
+    pending = conn.execute('SELECT entity, entity_id FROM purges WHERE finished_at IS NULL ORDER BY rowid').fetchall()
+    for table, id in pending:
+        purge_entity(conn, table, id, progress)
+    return len(pending)
+
+purge_executor = None
+purge_executor_lock = threading.Lock()
+
+def start_purges():
+    # один поток на процесс: очистки идут друг за другом, а не соревнуются за запись
+    global purge_executor
+    with purge_executor_lock:
+        if purge_executor is None:
+            purge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='purge')
+        purge_executor.submit(run_purges)
+
+def wait_purges():
+    # очередь однопоточная: пустая задача выполнится после всех поставленных
+    with purge_executor_lock:
+        executor = purge_executor
+    if executor is not None:
+        executor.submit(lambda: None).result()
+
+def run_purges():
+    conn = connect_db()
+    try:
+        purge_pending(conn)
     except Exception as e:
-        print(f"Ошибка удаления техники: {e}")
+        print(f"Ошибка фоновой очистки: {e}")
         conn.rollback()
-        return "Ошибка удаления", 500
     finally:
         conn.close()
-    return redirect('/admin/machines')
 
-@app.route('/delete/driver/<int:id>', methods=['POST'])
-def delete_driver(id):
-    conn = get_db()
+def purge_rows(conn):
+    rows = conn.execute('''
+        SELECT entity, entity_id, name, total, done, started_at, finished_at
+        FROM purges ORDER BY rowid DESC LIMIT ?
+    ''', (PURGES_SHOWN,)).fetchall()
+    return [{
+        'entity': entity,
+        'label': PURGE_LABELS[entity],
+        'id': id,
+        'name': name,
+        'total': total,
+        'done': min(done, total),
+        'started_at': started_at,
+        'finished_at': finished_at,
+    } for entity, id, name, total, done, started_at, finished_at in rows]
+
+@app.route('/admin/purges')
+def admin_purges():
+    purges = purge_rows(get_db())
+    if wants_json():
+        return jsonify(purges)
+    return render_template('admin_purges.html', purges=purges,
+                           running=any(p['finished_at'] is None for p in purges))
+
+@app.cli.command('purge-deleted')
+def purge_deleted_command():
+    """Дочищает записи удалённых техники, водителей и контрагентов в этом процессе."""
+    conn = connect_db()
     try:
-        conn.execute('DELETE FROM drivers WHERE id = ?', (id,))
-        conn.commit()
-    except Exception as e:
-        print(f"Ошибка удаления водителя: {e}")
-        conn.rollback()
-        return "Ошибка удаления", 500
+        count = purge_pending(conn, lambda n: click.echo(f"  удалено записей: {n}"))
     finally:
         conn.close()
-    return redirect('/admin/drivers')
+    clear_lookup_cache()
+    click.echo(f"Завершено очисток: {count}")
 
-@app.route('/delete/counterparty/<int:id>', methods=['POST'])
-def delete_counterparty(id):
+def delete_lookup_row(table, id, redirect_to):
     conn = get_db()
     try:
-        conn.execute('DELETE FROM counterparties WHERE id = ?', (id,))
+        deleted = soft_delete(conn, table, id)
         conn.commit()
     except Exception as e:
-        print(f"Ошибка удаления контрагента: {e}")
+        print(f"Ошибка удаления ({table}): {e}")
         conn.rollback()
         return "Ошибка удаления", 500
-    finally:
-        conn.close()
-    return redirect('/admin/counterparties')
+    if deleted:
+        start_purges()
+    return redirect(redirect_to)
+
+@app.route('/delete/machine/<int:id>', methods=['POST'])
+def delete_machine(id):
+    return delete_lookup_row('machines', id, '/admin/machines')
+
+@app.route('/delete/driver/<int:id>', methods=['POST'])
+def delete_driver(id):
+    return delete_lookup_row('drivers', id, '/admin/drivers')
+
+@app.route('/delete/counterparty/<int:id>', methods=['POST'])
+def delete_counterparty(id):
+    return delete_lookup_row('counterparties', id, '/admin/counterparties')
+
+RECORDS_DELETE_BATCH = 500
+
+def delete_records_by_id(conn, ids):
+    """Удаляет записи по id из рабочей базы одним DELETE на пачку в одной транзакции.
+
+    Не найденные в рабочей базе удаляются из архивов после её фиксации,
+    архивы трогаются, только если такие есть.
+    """
+    missing = []
+    for start in range(0, len(ids), RECORDS_DELETE_BATCH):
+        batch = ids[start:start + RECORDS_DELETE_BATCH]
+        marks = ','.join('?' * len(batch))
+        found = conn.execute(f'SELECT id, machine_id, date FROM records WHERE id IN ({marks})', batch).fetchall()
+        conn.execute(f'DELETE FROM records WHERE id IN ({marks})', batch)
+        # запись из архива удаляется без техники и даты: календари архивных лет не обновляются вживую
+        gone = sorted(set(batch) - {row[0] for row in found})
+        missing += gone
+        log_changes(conn, 'delete', found + [(id, None, None) for id in gone])
+    bump_data_version(conn)
+    conn.commit()
+    if missing and delete_from_archives(conn, 'id', missing):
+        bump_data_version(conn)
+        conn.commit()
 
 @app.route('/delete/record/<int:id>', methods=['POST'])
 def delete_record(id):
     conn = get_db()
     try:
-        conn.execute('DELETE FROM records WHERE id = ?', (id,))
-        conn.commit()
+        delete_records_by_id(conn, [id])
     except Exception as e:
         print(f"Ошибка удаления записи: {e}")
         conn.rollback()
         return "Ошибка удаления записи", 500
-    finally:
-        conn.close()
     return redirect('/admin/records')
 
-@app.route('/export')
-def export_excel():
+@app.route('/delete/records', methods=['POST'])
+def delete_records():
+    # отмеченные на странице записи удаляются одной транзакцией
+    ids = sorted({int(value) for value in request.form.getlist('ids') if value.isdigit()})
+    if not ids:
+        return redirect('/admin/records')
     conn = get_db()
     try:
-        rows = conn.execute('''
-            SELECT r.date, m.name, d.name, r.status,
-                   r.start_time, r.end_time, r.hours,
-                   c.name, r.comment
-            FROM records r
-            JOIN machines m ON r.machine_id = m.id
-            LEFT JOIN drivers d ON r.driver_id = d.id
-            LEFT JOIN counterparties c ON r.counterparty_id = c.id
-            ORDER BY r.date ASC
-        ''').fetchall()
+        delete_records_by_id(conn, ids)
+    except Exception as e:
+        print(f"Ошибка удаления записей: {e}")
+        conn.rollback()
+        return "Ошибка удаления записей", 500
+    return redirect('/admin/records')
+
+API_PAGE_SIZE = 500
+API_MAX_PAGE_SIZE = 5000
+API_CHUNK_SIZE = 1000
+API_RECORD_FIELDS = (
+    'id', 'date', 'machine_id', 'machine', 'driver_id', 'driver', 'status',
+    'start_time', 'end_time', 'hours', 'counterparty_id', 'counterparty', 'comment'
+)
+
+API_RECORD_COLUMNS = '''r.id, r.date, r.machine_id, r.driver_id, r.status,
+                        r.start_time, r.end_time, r.hours, r.counterparty_id, r.comment'''
+
+def api_record(row, lookups):
+    # строка API_RECORD_COLUMNS -> словарь с именами из справочников
+    return dict(zip(API_RECORD_FIELDS, (
+        row[0], row[1], row[2], lookups['machines'].get(row[2]), row[3], lookups['drivers'].get(row[3]),
+        row[4], row[5], row[6], row[7], row[8], lookups['counterparties'].get(row[8]), row[9]
+    )))
+
+def api_records_format():
+    if request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        return 'ndjson'
+    return 'json'
+
+@app.route('/api/records')
+@conditional_page(variant=api_records_format)
+def api_records():
+    """Записи в JSON (страница + next_cursor) или NDJSON-потоком (format=ndjson).
+
+    Фильтры те же, что у /admin/records; after=<date>_<id> продолжает выборку
+    с места, где закончилась предыдущая страница.
+    """
+    filters, where, params = parse_record_filters(request.args)
+    date_from, date_to = filters.get('date_from'), filters.get('date_to')
+    cursor = parse_record_cursor(request.args.get('after', ''))
+    if cursor:
+        where.append('(r.date < ? OR (r.date = ? AND r.id < ?))')
+        params += [cursor[0], cursor[0], cursor[1]]
+        date_to = min(date_to or cursor[0], cursor[0])
+    try:
+        limit = min(int(request.args.get('limit', 0)), API_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify(error='limit должен быть числом'), 400
+    if limit < 0:
+        return jsonify(error='limit не может быть отрицательным'), 400
+
+    lookups = get_lookups()
+
+    if api_records_format() == 'ndjson':
+        # поток живёт дольше запроса, поэтому у него своё соединение;
+        # без limit отдаются все подходящие записи, курсор читается частями
+        def generate():
+            conn = connect_db()
+            try:
+                rows = select_records(conn, API_RECORD_COLUMNS, where, params, 'date DESC, id DESC',
+                                      limit or None, archived_years(conn, date_from, date_to))
+                while True:
+                    chunk = rows.fetchmany(API_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield ''.join(json.dumps(api_record(row, lookups), ensure_ascii=False) + '\n'
+                                  for row in chunk)
+            finally:
+                conn.close()
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    limit = limit or API_PAGE_SIZE
+    rows = select_recent_records(get_db(), API_RECORD_COLUMNS, where, params, limit + 1, date_from, date_to)
+    next_cursor = f'{rows[limit - 1][1]}_{rows[limit - 1][0]}' if len(rows) > limit else None
+    return jsonify(
+        records=[api_record(row, lookups) for row in rows[:limit]],
+        next_cursor=next_cursor
+    )
+
+@app.route('/api/records', methods=['POST'])
+def api_create_records():
+    """Создаёт записи из JSON с полями формы /admin/records (см. expand_record_batch).
+
+    machine_id или driver_id (одно из двух) и weekdays можно передать списками; ответ 201 с числом
+    созданных записей, 409 со списком пересечений, 400 при ошибке ввода.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error='нужен JSON-объект'), 400
+    conn = get_db()
+    try:
+        rows = expand_record_batch({key: value if isinstance(value, list) else [value] for key, value in data.items()})
+        overlaps = insert_record_batch(conn, rows)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except Exception as e:
+        print(f"Ошибка создания записей: {e}")
+        conn.rollback()
+        return jsonify(error='ошибка создания записей'), 500
+    if overlaps:
+        return jsonify(error='пересечение по времени', overlaps=describe_overlaps(overlaps)), 409
+    return jsonify(created=len(rows)), 201
+
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 500
+# по релевантности сортируются только столько самых свежих совпадений: иначе слово,
+# встречающееся в каждой записи, заставляет считать bm25 по всей таблице
+SEARCH_RANK_WINDOW = 2000
+# границы совпадений в highlight/snippet; после экранирования заменяются на <mark>
+SEARCH_MARKS = ('\x02', '\x03')
+
+def search_match(text):
+    # слова от двух букв ищутся как префиксы ("гидравл" найдёт "гидравлики"), нужны все слова;
+    # однобуквенный префикс раскрывается в тысячи токенов, поэтому ищется точно
+    return ' '.join(f'"{word}"*' if len(word) > 1 else f'"{word}"'
+                    for word in re.findall(r'\w+', text))
+
+def search_records(conn, text, limit, offset):
+    """Записи, подходящие под строку поиска, по убыванию релевантности (bm25).
+
+    Ранжируются SEARCH_RANK_WINDOW самых свежих совпадений (граница — rowid, по нему
+    FTS5 отсекает без сортировки). Возвращает limit + 1 строк, чтобы вызывающий знал,
+    есть ли следующая страница.
+    """
+    match = search_match(text)
+    if not match:
+        return []
+    start, end = SEARCH_MARKS
+    hidden, hidden_params = hidden_records_where()
+    hidden_sql = ''.join(f' AND {condition}' for condition in hidden)
+    return conn.execute(f'''
+        SELECT r.id, r.date, r.status, r.hours, r.machine_id, r.driver_id, r.counterparty_id,
+               highlight(records_fts, 1, ?, ?), highlight(records_fts, 2, ?, ?),
+               highlight(records_fts, 3, ?, ?), snippet(records_fts, 0, ?, ?, '…', 16)
+        FROM records_fts
+        JOIN records r ON r.id = records_fts.rowid
+        WHERE records_fts MATCH ?
+          AND records_fts.rowid >= COALESCE((
+              SELECT rowid FROM records_fts WHERE records_fts MATCH ?
+              ORDER BY rowid DESC LIMIT 1 OFFSET ?
+          ), 0){hidden_sql}
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+    ''', (start, end) * 4 + (match, match, max(SEARCH_RANK_WINDOW, offset + limit + 1) - 1,
+                             *hidden_params, limit + 1, offset)).fetchall()
+
+def search_markup(value):
+    start, end = SEARCH_MARKS
+    return Markup(str(escape(value or '')).replace(start, '<mark>').replace(end, '</mark>'))
+
+@app.route('/search')
+@conditional_page
+@cached_page
+def search():
+    text = request.args.get('q', '').strip()
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+    rows = search_records(get_db(), text, SEARCH_PAGE_SIZE, (page - 1) * SEARCH_PAGE_SIZE) if text else []
+    results = [
+        (row[0], row[1], row[2], row[3], row[4], *(search_markup(value) for value in row[7:]))
+        for row in rows[:SEARCH_PAGE_SIZE]
+    ]
+    nav_links = []
+    if page > 1:
+        nav_links.append((f'/search?{urlencode({"q": text, "page": page - 1})}', '← Назад'))
+    if len(rows) > SEARCH_PAGE_SIZE:
+        nav_links.append((f'/search?{urlencode({"q": text, "page": page + 1})}', 'Дальше →'))
+    return render_template('search.html', q=text, page=page, results=results, nav_links=nav_links)
+
+@app.route('/api/search')
+@conditional_page
+def api_search():
+    """Поиск записей: q, limit, offset. snippet — фрагмент комментария в HTML с <mark>."""
+    text = request.args.get('q', '').strip()
+    try:
+        limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify(error='limit и offset должны быть числами'), 400
+    if not text or limit < 1:
+        return jsonify(error='нужен непустой q и limit больше 0'), 400
+
+    rows = search_records(get_db(), text, limit, offset)
+    lookups = get_lookups()
+    return jsonify(
+        results=[{
+            'id': row[0],
+            'date': row[1],
+            'status': row[2],
+            'hours': row[3],
+            'machine': lookups['machines'].get(row[4]),
+            'driver': lookups['drivers'].get(row[5]),
+            'counterparty': lookups['counterparties'].get(row[6]),
+            'snippet': str(search_markup(row[10]))
+        } for row in rows[:limit]],
+        next_offset=offset + limit if len(rows) > limit else None
+    )
+
+@app.route('/api/<any(machines, drivers, counterparties):table>')
+@conditional_page
+def api_lookup(table):
+    return jsonify([{'id': id, 'name': name} for id, name in get_lookups()[table].items()])
+
+# Заголовки столбцов файла импорта: как в отчёте /export или имена полей records
+IMPORT_COLUMNS = {
+    'дата': 'date', 'date': 'date',
+    'техника': 'machine', 'machine': 'machine',
+    'водитель': 'driver', 'driver': 'driver',
+    'статус': 'status', 'status': 'status',
+    'начало работы': 'start_time', 'start_time': 'start_time',
+    'конец работы': 'end_time', 'end_time': 'end_time',
+    'контрагент': 'counterparty', 'counterparty': 'counterparty',
+    'комментарий': 'comment', 'comment': 'comment'
+}
+IMPORT_REQUIRED_FIELDS = ('date', 'machine', 'driver', 'status')
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS_SHOWN = 200
+
+def decode_import_lines(stream):
+    """Строки CSV в UTF-8 (с BOM или без) или cp1251, как его сохраняет Excel в русской локали.
+
+    Файл читается как UTF-8; с первой строки, которая в UTF-8 не читается, —
+    как cp1251. Обе кодировки совпадают с ASCII, так что делить байты на
+    строки можно до выбора кодировки.
+    """
+    encoding = 'utf-8-sig'
+    for line in stream:
+        try:
+            yield line.decode(encoding)
+        except UnicodeDecodeError:
+            if encoding == 'cp1251':
+                raise
+            encoding = 'cp1251'
+            yield line.decode(encoding)
+
+def check_import_header(fields):
+    # без обязательных столбцов все строки отсеялись бы молча, как пустые
+    missing = [field for field in IMPORT_REQUIRED_FIELDS if field not in fields]
+    if missing:
+        titles = [next(title for title, f in IMPORT_COLUMNS.items() if f == field) for field in missing]
+        raise ValueError('в заголовке нет столбцов: ' + ', '.join(title.capitalize() for title in titles))
+
+def iter_import_rows(stream, filename):
+    """Построчно читает CSV или XLSX, отдаёт (номер строки, {поле: значение}).
+
+    Заголовок без обязательных столбцов — ValueError при чтении первой строки.
+    """
+    if filename.lower().endswith('.xlsx'):
+        wb = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = next(rows, None) or ()
+            fields = [IMPORT_COLUMNS.get(str(h or '').strip().lower()) for h in header]
+            check_import_header(fields)
+            for line_no, values in enumerate(rows, start=2):
+                yield line_no, {f: v for f, v in zip(fields, values) if f}
+        finally:
+            wb.close()
+        return
+
+    text = decode_import_lines(stream)
+    header_line = next(text, '')
+    # Excel в русской локали сохраняет CSV с разделителем ';'
+    delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+    header = next(csv.reader([header_line], delimiter=delimiter), [])
+    fields = [IMPORT_COLUMNS.get(h.strip().lower()) for h in header]
+    check_import_header(fields)
+    for line_no, values in enumerate(csv.reader(text, delimiter=delimiter), start=2):
+        yield line_no, {f: v for f, v in zip(fields, values) if f}
+
+def import_value(value):
+    if value is None:
+        return ''
+    value = str(value).strip()
+    # так пустые поля выглядят в выгрузке /export
+    return '' if value == '-' else value
+
+def import_date(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    value = import_value(value)
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise ValueError(f"неверная дата '{value}'")
+
+def import_time(value):
+    if hasattr(value, 'strftime'):
+        return value.strftime('%H:%M')
+    value = import_value(value)
+    if value:
+        try:
+            # приводится к ЧЧ:ММ, как у полей формы: 8:0 -> 08:00
+            value = datetime.strptime(value, '%H:%M').strftime('%H:%M')
+        except ValueError:
+            raise ValueError(f"неверное время '{value}'")
+    return value
+
+# статус принимается кодом (work), подписью (Работа) или как в отчёте (Work)
+IMPORT_STATUSES = dict(
+    [(s, s) for s in STATUS_LABELS] + [(label.lower(), s) for s, label in STATUS_LABELS.items()]
+)
+
+def import_records(conn, rows):
+    """Импортирует записи пачками по IMPORT_BATCH_SIZE, каждая пачка — одна транзакция.
+
+    Названия техники, водителей и контрагентов сопоставляются с ID через словари
+    в памяти; отсутствующие создаются. Смены, пересекающиеся по времени с другими
+    записями той же техники или водителя, не вставляются и идут в ошибки.
+    Возвращает (число записей, [(строка, ошибка)]). Если импорт прерывается посреди файла, незаписанная пачка откатывается, а
+    первой ошибкой идёт строка, с которой файл нужно загрузить заново.
+    """
+    lookups = {table: {} for table in LOOKUP_TABLES}
+    # удалённые, но ещё не вычищенные: новых записей по ним не принимаем
+    deleted = {table: set() for table in LOOKUP_TABLES}
+    for table in LOOKUP_TABLES:
+        for id, name, deleted_at in conn.execute(f'SELECT id, name, deleted_at FROM {table}'):
+            if deleted_at:
+                deleted[table].add(name)
+            else:
+                lookups[table][name] = id
+
+    created = []
+
+    def resolve(table, name):
+        if name not in lookups[table]:
+            lookups[table][name] = conn.execute(
+                f'INSERT INTO {table} (name) VALUES (?)', (name,)
+            ).lastrowid
+            created.append(name)
+        return lookups[table][name]
+
+    def insert(record, line_no):
+        # смена со временем проверяется на пересечения, как при вводе через форму
+        # и API: с уже внесёнными и с принятыми строками этого же файла
+        record_id = conn.execute('''
+            INSERT INTO records
+            (date, machine_id, driver_id, status, start_time, end_time, hours, comment, counterparty_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', record).lastrowid
+        overlaps = find_overlaps(conn, record_id) if record[4] and record[5] else []
+        if not overlaps:
+            return True
+        conn.execute('DELETE FROM records WHERE id = ?', (record_id,))
+        key, _, id, date, start, end, _ = overlaps[0]
+        same = 'та же техника' if key == 'machine_id' else 'тот же водитель'
+        more = f' и ещё с {len(overlaps) - 1}' if len(overlaps) > 1 else ''
+        errors.append((line_no, f'пересекается по времени с записью №{id} {ru_date(date)} {start}-{end} '
+                                f'({same}){more}'))
+        return False
+
+    def flush():
+        log_changes(conn, 'reset')
+        bump_data_version(conn)
+        if created:
+            bump_lookup_version(conn)
+            created.clear()
+        conn.commit()
+
+    imported = 0
+    errors = []
+    # строки, вставленные в текущей ещё не записанной пачке
+    batch = 0
+    # первая строка незаписанной пачки: с неё продолжается прерванный импорт
+    line_no = batch_line = None
+    try:
+        for line_no, row in rows:
+            try:
+                if not any(import_value(v) for v in row.values()):
+                    continue
+                date_str = import_date(row.get('date'))
+                machine = import_value(row.get('machine'))
+                driver = import_value(row.get('driver'))
+                if not machine or not driver:
+                    raise ValueError('не указаны техника или водитель')
+                status = IMPORT_STATUSES.get(import_value(row.get('status')).lower())
+                if status is None:
+                    raise ValueError(f"неизвестный статус '{import_value(row.get('status'))}'")
+                start_time = import_time(row.get('start_time'))
+                end_time = import_time(row.get('end_time'))
+                hours = calc_hours(start_time, end_time) if start_time and end_time else 0
+                counterparty = import_value(row.get('counterparty'))
+                for table, name in (('machines', machine), ('drivers', driver), ('counterparties', counterparty)):
+                    if name in deleted[table]:
+                        raise ValueError(f"'{name}' удалён, записи по нему не принимаются")
+            except ValueError as e:
+                errors.append((line_no, str(e)))
+                continue
+
+            if not batch:
+                batch_line = line_no
+            if insert((
+                date_str,
+                resolve('machines', machine),
+                resolve('drivers', driver),
+                status,
+                start_time or None,
+                end_time or None,
+                hours,
+                import_value(row.get('comment')),
+                resolve('counterparties', counterparty) if counterparty else None
+            ), line_no):
+                batch += 1
+            if batch >= IMPORT_BATCH_SIZE:
+                flush()
+                imported += batch
+                batch = 0
+        if batch:
+            flush()
+            imported += batch
+    except Exception as e:
+        conn.rollback()
+        if line_no is None:
+            raise
+        print(f"Ошибка импорта на строке {line_no}: {e}")
+        resume_line = batch_line if batch else line_no
+        # первой: на странице импорта показываются только первые ошибки
+        errors.insert(0, (line_no, f'импорт прерван ({e}); записи до строки {resume_line} сохранены, '
+                                   f'строки с {resume_line} нужно загрузить заново'))
+    return imported, errors
+
+@app.route('/admin/import', methods=['GET', 'POST'])
+def admin_import():
+    result = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            return redirect('/admin/import')
+        conn = get_db()
+        try:
+            imported, errors = import_records(conn, iter_import_rows(upload.stream, upload.filename))
+        except UnicodeDecodeError:
+            return "Файл не в UTF-8 и не в cp1251 — сохраните CSV в одной из этих кодировок", 400
+        except ValueError as e:
+            return f"Файл не подходит для импорта: {e}", 400
+        except Exception as e:
+            print(f"Ошибка импорта: {e}")
+            return "Ошибка импорта", 500
+        result = {
+            'filename': upload.filename,
+            'imported': imported,
+            'error_count': len(errors),
+            'errors': errors[:IMPORT_MAX_ERRORS_SHOWN]
+        }
+    return render_template('admin_import.html', result=result)
+
+@app.cli.command('import-records')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_records_command(path):
+    """Импортирует записи из CSV или XLSX файла."""
+    conn = connect_db()
+    try:
+        with open(path, 'rb') as stream:
+            imported, errors = import_records(conn, iter_import_rows(stream, path))
+    except UnicodeDecodeError:
+        click.echo("Файл не в UTF-8 и не в cp1251")
+        raise SystemExit(1)
+    except ValueError as e:
+        click.echo(f"Файл не подходит для импорта: {e}")
+        raise SystemExit(1)
     finally:
         conn.close()
+    for line_no, message in errors:
+        click.echo(f"строка {line_no}: {message}")
+    click.echo(f"Импортировано записей: {imported}, ошибок: {len(errors)}")
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "AN-30 Отчёт"
+# Аналитика по технике: записи периода выбираются столбцами целых чисел
+# (analytics.load_columns) и сводятся векторно в analytics.py
+STATUS_CODES = {status: code for code, status in enumerate(STATUS_LABELS)}
+ANALYTICS_COLUMNS = (
+    'CAST(julianday(r.date) - 2440587.5 AS INTEGER), r.machine_id, CASE r.status '
+    + ' '.join(f"WHEN '{status}' THEN {code}" for status, code in STATUS_CODES.items())
+    + ' ELSE -1 END, COALESCE(r.hours, 0), COALESCE(r.counterparty_id, 0)'
+)
+ANALYTICS_HEADERS = [
+    "Техника", "Записей", "Дней работы", "Загрузка, %", "Часы работы",
+    "Дней ремонта", "Дней простоя", "Серий простоя", "Самый долгий простой, дн."
+]
 
-    headers = [
-        "Дата", "Техника", "Водитель", "Статус",
-        "Начало работы", "Конец работы", "Часы",
-        "Контрагент", "Комментарий"
-    ]
-    ws.append(headers)
+def epoch_day(value):
+    return (datetime.strptime(value, '%Y-%m-%d') - datetime(1970, 1, 1)).days
+
+def analytics_report(conn, where, params, date_from, date_to):
+    """Сводки по технике и контрагентам за дни [date_from, date_to] ('YYYY-MM-DD').
+
+    Возвращает строки за весь период и по месяцам: [месяц, техника, значения
+    ANALYTICS_HEADERS[1:]...], и часы контрагентов: [месяц, контрагент, часы].
+    """
+    cursor = select_records(conn, ANALYTICS_COLUMNS, where + ['r.date BETWEEN ? AND ?'],
+                            list(params) + [date_from, date_to], None,
+                            years=archived_years(conn, date_from, date_to))
+    columns = analytics.load_columns(cursor)
+    first_day, last_day = epoch_day(date_from), epoch_day(date_to)
+    lookups = get_lookups(conn)
+    machines, counterparties = lookups['machines'], lookups['counterparties']
 
+    def machine_rows(monthly):
+        ids, starts, stats = analytics.machine_stats(columns, first_day, last_day, STATUS_CODES, monthly)
+        stats['utilization'] = stats['utilization'].round(1)
+        stats['work_hours'] = stats['work_hours'].astype(int)
+        values = [stats[field].tolist() for field in analytics.MACHINE_FIELDS]
+        return [
+            [str(start)[:7], machines[machine_id]] + [field[k] for field in values]
+            for k, (machine_id, start) in enumerate(zip(ids.tolist(), starts))
+            if machine_id in machines
+        ]
+
+    ids, starts, hours = analytics.counterparty_hours(columns, first_day, last_day)
+    hours = hours.astype(int).tolist()
+    return {
+        'records': columns.shape[1],
+        'period': [row[1:] for row in machine_rows(monthly=False)],
+        'months': machine_rows(monthly=True),
+        'counterparties': [
+            [str(start)[:7], counterparties[counterparty_id], hours[k]]
+            for k, (counterparty_id, start) in enumerate(zip(ids.tolist(), starts))
+            if hours[k] and counterparty_id in counterparties
+        ],
+    }
+
+# самый длинный период страницы /analytics: дальше отчёт слишком велик для одной страницы
+ANALYTICS_MAX_DAYS = 5 * 366
+
+@app.route('/analytics')
+@conditional_page
+@cached_page
+def analytics_page():
+    # по умолчанию — с начала года по сегодня; фильтры те же, что у списка записей
+    filters, where, params = parse_record_filters(request.args)
+    today = datetime.now().strftime('%Y-%m-%d')
+    date_from = filters.get('date_from', f'{today[:4]}-01-01')
+    date_to = filters.get('date_to', today)
+    if date_to < date_from:
+        return redirect('/analytics?' + urlencode(dict(filters, date_from=date_to, date_to=date_from)))
+    if int(date_from[:4]) not in CALENDAR_YEARS or int(date_to[:4]) not in CALENDAR_YEARS:
+        return redirect('/analytics')
+    last_day = datetime.strptime(date_from, '%Y-%m-%d') + timedelta(days=ANALYTICS_MAX_DAYS - 1)
+    if date_to > last_day.strftime('%Y-%m-%d'):
+        return redirect('/analytics?' + urlencode(dict(filters, date_to=last_day.strftime('%Y-%m-%d'))))
+    report = analytics_report(get_db(), where, params, date_from, date_to)
+    totals = {}
+    for month, counterparty, hours in report['counterparties']:
+        totals[counterparty] = totals.get(counterparty, 0) + hours
+    all_hours = sum(totals.values())
+    return render_template(
+        'analytics.html',
+        report=report,
+        headers=ANALYTICS_HEADERS,
+        counterparty_totals=[
+            (name, hours, round(100 * hours / all_hours, 1))
+            for name, hours in sorted(totals.items(), key=lambda item: -item[1])
+        ],
+        filters=dict(filters, date_from=date_from, date_to=date_to),
+        max_days=ANALYTICS_MAX_DAYS
+    )
+
+EXPORT_HEADERS = [
+    "Дата", "Техника", "Водитель", "Статус",
+    "Начало работы", "Конец работы", "Часы",
+    "Контрагент", "Комментарий"
+]
+EXPORT_CHUNK_SIZE = 5000
+# до этого размера файл отчёта держится в памяти, дальше уходит во временный файл
+EXPORT_SPOOL_SIZE = 8 * 1024 * 1024
+EXPORT_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXPORT_JOB_ID_RE = re.compile(r'[0-9a-f]{40}')
+
+def build_report(conn, fileobj, args):
+    """Пишет xlsx-отчёт по записям (с фильтрами /admin/records) в fileobj."""
+    filters, where, params = parse_record_filters(args, conn)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("AN-30 Отчёт")
+    for col in range(1, len(EXPORT_HEADERS) + 1):
+        ws.column_dimensions[get_column_letter(col)].width = 20
+
+    # стили создаются один раз и переиспользуются всеми ячейками
     header_fill = PatternFill(start_color="444444", fill_type="solid")
     header_font = Font(color="FFFFFF", bold=True)
+    # убираем '#' у цвета, чтобы остался только HEX
+    status_fills = {
+        status: PatternFill(start_color=color[1:], fill_type="solid")
+        for status, color in COLORS['status'].items()
+    }
 
-    for col in range(1, len(headers)+1):
-        cell = ws.cell(row=1, column=col)
+    header_row = []
+    for title in EXPORT_HEADERS:
+        cell = WriteOnlyCell(ws, value=title)
         cell.fill = header_fill
         cell.font = header_font
-        ws.column_dimensions[get_column_letter(col)].width = 20
+        header_row.append(cell)
+    ws.append(header_row)
 
-    for row in rows:
-        date_fmt = datetime.strptime(row[0], '%Y-%m-%d').strftime('%d.%m.%Y')
-        # убираем '#' у цвета, чтобы остался только HEX
-        status_hex = COLORS['status'].get(row[3], '#FFFFFF')[1:]
-        ws.append([
-            date_fmt,
-            row[1] or "-",
-            row[2] or "-",
-            row[3].capitalize(),
-            row[4] or "-",
-            row[5] or "-",
-            row[6] or "0",
-            row[7] or "-",
-            row[8] or "-"
-        ])
-        # подсветка статуса
-        status_cell = ws.cell(row=ws.max_row, column=4)
-        status_cell.fill = PatternFill(start_color=status_hex, fill_type="solid")
-
-    filename = f"report_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
-    wb.save(filename)
+    lookups = get_lookups(conn)
+    machines, drivers, counterparties = (lookups[table] for table in LOOKUP_TABLES)
+    # id нужен только для порядка слияния с архивами, в отчёт не попадает
+    cursor = select_records(
+        conn, '''r.date, r.machine_id, r.driver_id, r.status,
+                 r.start_time, r.end_time, r.hours,
+                 r.counterparty_id, r.comment, r.id''',
+        where, params, 'date, id',
+        years=archived_years(conn, filters.get('date_from'), filters.get('date_to'))
+    )
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            # подсветка статуса
+            status_cell = WriteOnlyCell(ws, value=row[3].capitalize())
+            if row[3] in status_fills:
+                status_cell.fill = status_fills[row[3]]
+            ws.append([
+                datetime.strptime(row[0], '%Y-%m-%d').strftime('%d.%m.%Y'),
+                machines.get(row[1]) or "-",
+                drivers.get(row[2]) or "-",
+                status_cell,
+                row[4] or "-",
+                row[5] or "-",
+                row[6] or "0",
+                counterparties.get(row[7]) or "-",
+                row[8] or "-"
+            ])
+
+    # сводка по месяцам читается из monthly_machine_stats, а не пересчитывается по records;
+    # из фильтров к ней применимы только техника и диапазон месяцев
+    summary = wb.create_sheet("Сводка по технике")
+    summary_headers = ["Месяц", "Техника", "Часы"] + [STATUS_LABELS[s] for s in STATUS_LABELS]
+    for col in range(1, len(summary_headers) + 1):
+        summary.column_dimensions[get_column_letter(col)].width = 20
+    header_row = []
+    for title in summary_headers:
+        cell = WriteOnlyCell(summary, value=title)
+        cell.fill = header_fill
+        cell.font = header_font
+        header_row.append(cell)
+    summary.append(header_row)
+
+    summary_where = []
+    summary_params = []
+    if 'machine_id' in filters:
+        summary_where.append('s.machine_id = ?')
+        summary_params.append(int(filters['machine_id']))
+    if 'date_from' in filters:
+        summary_where.append('s.month >= ?')
+        summary_params.append(filters['date_from'][:7])
+    if 'date_to' in filters:
+        summary_where.append('s.month <= ?')
+        summary_params.append(filters['date_to'][:7])
+
+    hidden = deleted_driver_totals(
+        conn, filters['date_from'][:7] + '-01' if 'date_from' in filters else None,
+        filters['date_to'][:7] + '-31' if 'date_to' in filters else None,
+        int(filters['machine_id']) if 'machine_id' in filters else None, monthly=True
+    )
+    current = current_key = None
+    for month, machine_id, status, record_count, hours in conn.execute(f'''
+        SELECT s.month, s.machine_id, s.status, s.record_count, s.hours
+        FROM monthly_machine_stats s
+        {('WHERE ' + ' AND '.join(summary_where)) if summary_where else ''}
+        ORDER BY s.month, s.machine_id
+    ''', summary_params):
+        if machine_id not in machines:
+            continue
+        hidden_count, hidden_hours = hidden.get((machine_id, month, status), (0, 0))
+        record_count, hours = record_count - hidden_count, hours - hidden_hours
+        if record_count <= 0:
+            continue
+        if current_key != (month, machine_id):
+            if current is not None:
+                summary.append(current)
+            current_key = (month, machine_id)
+            current = [month, machines.get(machine_id) or "-", 0] + [0] * len(STATUS_LABELS)
+        current[2] += hours
+        current[3 + list(STATUS_LABELS).index(status)] += record_count
+    if current is not None:
+        summary.append(current)
+
+    # аналитика за период фильтра, урезанный до дней, за которые есть записи
+    sheet = wb.create_sheet("Аналитика")
+    for col in range(1, len(ANALYTICS_HEADERS) + 2):
+        sheet.column_dimensions[get_column_letter(col)].width = 20
+    years = archived_years(conn)
+    low, high = conn.execute('SELECT (SELECT MIN(date) FROM records), (SELECT MAX(date) FROM records)').fetchone()
+    low = f'{years[0]}-01-01' if years else low
+    high = high or (f'{years[-1]}-12-31' if years else None)
+    date_from = max(filter(None, (filters.get('date_from'), low)), default=None)
+    date_to = min(filter(None, (filters.get('date_to'), high)), default=None)
+    report = analytics_report(conn, where, params, date_from, date_to) \
+        if date_from and date_to and date_from <= date_to else {'months': [], 'counterparties': []}
+    for headers, rows in ((["Месяц"] + ANALYTICS_HEADERS, report['months']),
+                          (["Месяц", "Контрагент", "Часы"], report['counterparties'])):
+        header_row = []
+        for title in headers:
+            cell = WriteOnlyCell(sheet, value=title)
+            cell.fill = header_fill
+            cell.font = header_font
+            header_row.append(cell)
+        sheet.append(header_row)
+        for row in rows:
+            sheet.append(row)
+        sheet.append([])
+
+    wb.save(fileobj)
+
+def report_filename():
+    return f"report_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
+
+@app.route('/export')
+@conditional_page
+def export_excel():
+    # готовый отчёт с теми же фильтрами и данными отдаётся из кэша фоновых выгрузок
+    job_id = export_job_id(request.args)
+    if export_job_status(job_id) == 'done':
+        return send_export_artifact(job_id)
+
+    report = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    build_report(get_db(), report, request.args)
+    report.seek(0)
 
     return send_file(
-        filename,
+        report,
         as_attachment=True,
-        download_name=filename,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        download_name=report_filename(),
+        mimetype=EXPORT_MIMETYPE
     )
 
+# Фоновые выгрузки. Состояние задачи хранится файлами в EXPORT_CACHE_DIR, поэтому
+# видно всем воркерам gunicorn: <id>.part — строится, <id>.xlsx — готов, <id>.error — ошибка.
+# id задачи — хэш фильтров и состояния данных, так что повторный запрос того же
+# отчёта при неизменных данных сразу получает готовый файл. В состоянии — путь и
+# id базы: каталог общий для всех баз, а data_version пересозданной базы снова
+# начинается с нуля; и время изменения: после восстановления из копии
+# data_version повторяет уже виденные значения с другими данными.
+export_executor = None
+export_executor_lock = threading.Lock()
+
+def get_export_executor():
+    global export_executor
+    with export_executor_lock:
+        if export_executor is None:
+            export_executor = ThreadPoolExecutor(
+                max_workers=app.config['EXPORT_WORKERS'], thread_name_prefix='export'
+            )
+        return export_executor
+
+def export_job_id(args):
+    filters = parse_record_filters(args)[0]
+    key = json.dumps([app.config['DATABASE'], get_database_id(), *get_data_state(), sorted(filters.items())])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def export_job_paths(job_id):
+    base = os.path.join(app.config['EXPORT_CACHE_DIR'], job_id)
+    return base + '.xlsx', base + '.part', base + '.error'
+
+def export_job_status(job_id):
+    done, part, error = export_job_paths(job_id)
+    if os.path.exists(done):
+        return 'done'
+    if os.path.exists(error):
+        return 'failed'
+    try:
+        if time.time() - os.path.getmtime(part) < app.config['EXPORT_JOB_TIMEOUT']:
+            return 'running'
+    except OSError:
+        pass
+    return None
+
+def start_export_job(args):
+    job_id = export_job_id(args)
+    status = export_job_status(job_id)
+    if status in ('done', 'running'):
+        return job_id
+
+    done, part, error = export_job_paths(job_id)
+    os.makedirs(app.config['EXPORT_CACHE_DIR'], exist_ok=True)
+    for path in (part, error):
+        # зависшая или упавшая задача запускается заново
+        if os.path.exists(path):
+            os.remove(path)
+    try:
+        # создание .part с O_EXCL — захват задачи, если её одновременно запускают два воркера
+        open(part, 'xb').close()
+    except FileExistsError:
+        return job_id
+    get_export_executor().submit(run_export_job, job_id, dict(args))
+    return job_id
+
+def run_export_job(job_id, args):
+    done, part, error = export_job_paths(job_id)
+    try:
+        conn = connect_db()
+        try:
+            with open(part, 'wb') as fileobj:
+                build_report(conn, fileobj, args)
+        finally:
+            conn.close()
+        os.replace(part, done)
+    except Exception as e:
+        print(f"Ошибка фоновой выгрузки {job_id}: {e}")
+        with open(error, 'w', encoding='utf-8') as f:
+            f.write(str(e))
+        if os.path.exists(part):
+            os.remove(part)
+    finally:
+        evict_export_cache()
+
+def evict_export_cache():
+    """Удаляет готовые отчёты старше EXPORT_CACHE_MAX_AGE и самые давние сверх EXPORT_CACHE_MAX_BYTES."""
+    directory = app.config['EXPORT_CACHE_DIR']
+    now = time.time()
+    files = []
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(('.xlsx', '.error')):
+            continue
+        stat = entry.stat()
+        if now - stat.st_mtime > app.config['EXPORT_CACHE_MAX_AGE']:
+            os.remove(entry.path)
+        else:
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= app.config['EXPORT_CACHE_MAX_BYTES']:
+            break
+        os.remove(path)
+        total -= size
+
+def send_export_artifact(job_id):
+    done = export_job_paths(job_id)[0]
+    # отметка использования: вытесняются давно не запрашиваемые отчёты
+    os.utime(done)
+    return send_file(
+        done,
+        as_attachment=True,
+        download_name=report_filename(),
+        mimetype=EXPORT_MIMETYPE
+    )
+
+def wants_json():
+    return request.args.get('format') == 'json' \
+        or request.accept_mimetypes.best == 'application/json'
+
+def export_job_info(job_id):
+    return {
+        'id': job_id,
+        'status': export_job_status(job_id) or 'unknown',
+        'status_url': f'/export/jobs/{job_id}',
+        'download_url': f'/export/jobs/{job_id}/download'
+    }
+
+@app.route('/export/jobs', methods=['GET', 'POST'])
+def export_jobs():
+    args = request.form if request.method == 'POST' else request.args
+    job_id = start_export_job(args)
+    if request.method == 'POST' or wants_json():
+        return jsonify(export_job_info(job_id)), 202
+    return redirect(f'/export/jobs/{job_id}')
+
+@app.route('/export/jobs/<job_id>')
+def export_job(job_id):
+    if not EXPORT_JOB_ID_RE.fullmatch(job_id):
+        return "Выгрузка не найдена", 404
+    info = export_job_info(job_id)
+    if wants_json():
+        return jsonify(info)
+    return render_template('export_job.html', job=info)
+
+@app.route('/export/jobs/<job_id>/download')
+def export_job_download(job_id):
+    if not EXPORT_JOB_ID_RE.fullmatch(job_id) or export_job_status(job_id) != 'done':
+        return "Выгрузка не найдена", 404
+    return send_export_artifact(job_id)
+
+SEED_COMMENTS = ('', '', '', 'Объект №2', 'Ночная смена', 'Ожидание материалов', 'Замена гидравлики')
+
+def seed_db(conn, machines=20, drivers=20, counterparties=10, days=365, seed=30):
+    """Заполняет пустую базу синтетическими данными (для проверок и замеров).
+
+    По записи на технику в день: в будни в основном работа (иногда ночные смены
+    через полночь), выходные по воскресеньям, простои и многодневные ремонты.
+    """
+    rnd = random.Random(seed)
+    conn.executemany('INSERT INTO machines (name) VALUES (?)',
+                     [(f'Техника {i}',) for i in range(1, machines + 1)])
+    conn.executemany('INSERT INTO drivers (name) VALUES (?)',
+                     [(f'Водитель {i}',) for i in range(1, drivers + 1)])
+    conn.executemany('INSERT INTO counterparties (name) VALUES (?)',
+                     [(f'Контрагент {i}',) for i in range(1, counterparties + 1)])
+    bump_lookup_version(conn)
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+
+    def rows():
+        repair_left = [0] * (machines + 1)
+        driver_of = [rnd.randint(1, drivers) for _ in range(machines + 1)]
+        client_of = [rnd.randint(1, counterparties) for _ in range(machines + 1)]
+        for day in range(days + 1):
+            current = start + timedelta(days=day)
+            date_str = current.strftime('%Y-%m-%d')
+            for machine_id in range(1, machines + 1):
+                # водитель и контрагент закреплены за техникой и меняются время от времени
+                if rnd.random() < 0.05:
+                    driver_of[machine_id] = rnd.randint(1, drivers)
+                if rnd.random() < 0.1:
+                    client_of[machine_id] = rnd.randint(1, counterparties)
+                if repair_left[machine_id] == 0 and rnd.random() < 0.01:
+                    repair_left[machine_id] = rnd.randint(2, 14)
+
+                start_time = end_time = counterparty_id = None
+                if repair_left[machine_id]:
+                    repair_left[machine_id] -= 1
+                    status = 'repair'
+                elif current.weekday() == 6:
+                    status = 'holiday'
+                elif rnd.random() < 0.12:
+                    status = 'stop'
+                else:
+                    status = 'work'
+                    if rnd.random() < 0.1:
+                        start_time, end_time = f'{rnd.randint(19, 22)}:00', f'0{rnd.randint(4, 7)}:00'
+                    else:
+                        start_time, end_time = f'0{rnd.randint(6, 9)}:00', f'{rnd.randint(15, 20)}:{rnd.choice(("00", "30"))}'
+                    counterparty_id = client_of[machine_id]
+                yield (date_str, machine_id, driver_of[machine_id], status, start_time, end_time,
+                       calc_hours(start_time, end_time) if start_time else 0,
+                       rnd.choice(SEED_COMMENTS), counterparty_id)
+
+    conn.executemany('''
+        INSERT INTO records
+        (date, machine_id, driver_id, status, start_time, end_time, hours, comment, counterparty_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows())
+    conn.commit()
+
+@app.cli.command('seed-db')
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--machines', default=20, show_default=True)
+@click.option('--drivers', default=20, show_default=True)
+@click.option('--counterparties', default=10, show_default=True)
+@click.option('--days', default=365, show_default=True)
+@click.option('--seed', default=30, show_default=True, help='Зерно генератора (для воспроизводимости).')
+def seed_db_command(path, machines, drivers, counterparties, days, seed):
+    """Создаёт в PATH черновую базу с синтетическими данными."""
+    if os.path.abspath(path) == os.path.abspath(app.config['DATABASE']):
+        raise click.UsageError('PATH совпадает с рабочей базой приложения')
+    # черновая база создаётся заново
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    old_database = app.config['DATABASE']
+    app.config['DATABASE'] = path
+    try:
+        init_db()
+        conn = connect_db()
+        try:
+            seed_db(conn, machines, drivers, counterparties, days, seed)
+            count = conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        finally:
+            conn.close()
+    finally:
+        app.config['DATABASE'] = old_database
+    click.echo(f'{path}: записей {count}')
+
+# Маленькие справочники, реестр архивов и журнал очисток выводятся целиком, полный проход по ним допустим
+PLAN_SCAN_ALLOWED = ('machines', 'drivers', 'counterparties', 'archive_years', 'purges')
+
+def plan_problems(conn, sql):
+    problems = []
+    for row in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+        detail = row[3]
+        if 'USE TEMP B-TREE' in detail:
+            problems.append(detail)
+        elif detail.startswith('SCAN ') and 'USING' not in detail and 'VIRTUAL TABLE' not in detail \
+                and detail != 'SCAN CONSTANT ROW' and detail.split()[1] not in PLAN_SCAN_ALLOWED:
+            problems.append(detail)
+    return problems
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Прогоняет все страницы на тестовой базе и проверяет планы всех запросов."""
+    statements = []
+    checked = set()
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        old_database = app.config['DATABASE']
+        app.config['DATABASE'] = os.path.join(tmp, 'plans.db')
+        app.config['SQL_TRACE'] = statements.append
+        try:
+            init_db()
+            clear_page_cache()
+            today = datetime.now()
+            conn = connect_db()
+            seed_db(conn)
+            # прошлый год уходит в архив, чтобы проверить и запросы с ATTACH
+            archive_year(conn, today.year - 1)
+            conn.close()
+
+            client = app.test_client()
+            for url in ('/', '/calendar/1', f'/calendar/1?year={today.year - 1}&month=1',
+                        '/board', f'/board?date_from={today.year}-01-01&date_to={today.year}-03-31',
+                        '/admin/machines', '/admin/drivers', '/admin/counterparties',
+                        '/admin/records', '/admin/records?per_page=50&after=' + today.strftime('%Y-%m-%d') + '_100',
+                        '/admin/records?before=' + today.strftime('%Y-%m-%d') + '_100',
+                        '/admin/records?machine_id=1', '/admin/records?driver_id=1',
+                        '/admin/records?counterparty_id=1', '/admin/records?status=repair',
+                        f'/admin/records?date_from={today.year}-01-01&date_to={today.year}-01-31',
+                        '/export', f'/export?machine_id=1&date_from={today.year}-01-01', '/api/records', '/api/records?machine_id=1&limit=10',
+                        '/api/records?format=ndjson&driver_id=1&after=' + today.strftime('%Y-%m-%d') + '_100',
+                        '/api/machines', '/search?q=Замена', '/api/search?q=Водитель+гидр&offset=10',
+                        '/analytics', f'/analytics?machine_id=1&date_from={today.year - 1}-06-01&date_to={today.year}-12-31',
+                        f'/admin/records?date_from={today.year - 1}-12-01&date_to={today.year}-01-31',
+                        f'/admin/records?machine_id=1&after={today.year}-01-02_1000000',
+                        f'/export?date_from={today.year - 1}-12-01&date_to={today.year}-01-31',
+                        f'/api/records?format=ndjson&limit=5&after={today.year}-01-02_1000000'):
+                client.get(url)
+            # смена через полночь: проверка пересечений задевает и предыдущие сутки
+            client.post('/admin/records', data={'date': today.strftime('%Y-%m-%d'), 'machine_id': '1', 'driver_id': '1',
+                                                'status': 'work', 'start_time': '22:00', 'end_time': '06:00'})
+            for url in (f'/calendar/1/days?date_from={today:%Y-%m-%d}&date_to={today:%Y-%m-%d}',
+                        '/admin/records/rows?ids=1,2,3&machine_id=1'):
+                client.get(url)
+            client.post('/api/records', json={'date': today.strftime('%Y-%m-%d'), 'date_to': (today + timedelta(days=30)).strftime('%Y-%m-%d'),
+                                              'weekdays': [0, 1, 2, 3, 4], 'machine_id': [2, 3], 'driver_id': 2, 'status': 'repair'})
+            client.post('/delete/records', data={'ids': ['2', '3', '1000000']})
+            for url in ('/delete/record/1', '/delete/counterparty/1',
+                        '/delete/driver/1', '/delete/machine/1'):
+                client.post(url)
+            # страницы, пока записи удалённых ещё не вычищены, и сама очистка
+            for url in ('/admin/records', '/calendar/2', '/board', '/search?q=Замена', '/admin/purges'):
+                client.get(url)
+            wait_purges()
+            # отставший клиент /events дочитывает ленту из базы
+            changes_after(-1)
+            app.config.pop('SQL_TRACE')
+
+            conn = sqlite3.connect(app.config['DATABASE'])
+            attach_archives(conn, archived_years(conn)[:ARCHIVE_ATTACH_MAX])
+            for sql in statements:
+                if sql in checked or sql.split(None, 1)[0].upper() not in ('SELECT', 'WITH', 'UPDATE', 'DELETE'):
+                    continue
+                # служебные запросы FTS5 к своим теневым таблицам
+                if "'main'." in sql:
+                    continue
+                checked.add(sql)
+                problems = plan_problems(conn, sql)
+                if problems:
+                    failed = True
+                    click.echo(f"FAIL: {' '.join(sql.split())}")
+                    for detail in problems:
+                        click.echo(f"    {detail}")
+            conn.close()
+        finally:
+            app.config['DATABASE'] = old_database
+            app.config.pop('SQL_TRACE', None)
+
+    click.echo(f"Проверено запросов: {len(checked)}")
+    if failed:
+        raise SystemExit(1)
+
+# шаблоны компилируются один раз при загрузке приложения, а не на первом запросе
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
 if __name__ == '__main__':
     init_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,256 @@
+"""Нагрузочный замер маршрутов на синтетических базах разного размера.
+
+Для каждого размера создаётся черновая база (seed_db), затем все маршруты
+прогоняются через тестовый клиент Flask или через локальный gunicorn.
+По каждому маршруту печатаются пропускная способность и p50/p95/p99.
+gunicorn запускается с флагами воркеров из строки web: Procfile, как в проде;
+базы, кэш выгрузок и метрики лежат во временном каталоге замера.
+
+Запуск из корня проекта:
+    python benchmarks/load.py --days 90 365 --requests 200
+    python benchmarks/load.py --gunicorn --workers 4 --concurrency 8
+    python benchmarks/load.py --save benchmarks/baselines/client.json
+    python benchmarks/load.py --compare benchmarks/baselines/client.json
+"""
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as an30
+
+# во сколько раз p95 может ухудшиться относительно базового замера
+REGRESSION_FACTOR = 1.2
+
+
+def route_plan(machines, rnd):
+    """Маршруты замера: имя -> функция, возвращающая (метод, путь, данные формы)."""
+    today = datetime.now()
+    state = {'record_id': 0, 'day': 0}
+
+    def calendar():
+        month = rnd.randint(1, 12)
+        return 'GET', f'/calendar/{rnd.randint(1, machines)}?year={today.year}&month={month}', None
+
+    def admin_records():
+        return 'GET', f'/admin/records?machine_id={rnd.randint(1, machines)}', None
+
+    def add_record():
+        # каждый раз новый день после истории, чтобы запись не отклонялась как пересечение
+        state['day'] += 1
+        return 'POST', '/admin/records', {
+            'date': (today + timedelta(days=state['day'])).strftime('%Y-%m-%d'),
+            'machine_id': str(rnd.randint(1, machines)),
+            'driver_id': '1',
+            'status': 'work',
+            'start_time': '08:00',
+            'end_time': '17:00',
+        }
+
+    def delete_record():
+        # удаляются записи с начала таблицы, каждая ровно один раз
+        state['record_id'] += 1
+        return 'POST', f'/delete/record/{state["record_id"]}', None
+
+    return {
+        'index': lambda: ('GET', '/', None),
+        'board': lambda: ('GET', '/board', None),
+        'calendar': calendar,
+        'admin_records': admin_records,
+        'api_records': lambda: ('GET', '/api/records?limit=500', None),
+        'export': lambda: ('GET', f'/export?machine_id={rnd.randint(1, machines)}', None),
+        'add_record': add_record,
+        'delete_record': delete_record,
+    }
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(timings, elapsed):
+    return {
+        'requests': len(timings),
+        'rps': len(timings) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+    }
+
+
+def run_client(database, plan, requests, cold):
+    an30.app.config['DATABASE'] = database
+    an30.clear_page_cache()
+    client = an30.app.test_client()
+    results = {}
+    for name, make_request in plan.items():
+        timings = []
+        started = time.perf_counter()
+        for _ in range(requests):
+            method, path, data = make_request()
+            if cold:
+                an30.clear_page_cache()
+            t = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            response.get_data()
+            timings.append(time.perf_counter() - t)
+        results[name] = summarize(timings, time.perf_counter() - started)
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def procfile_gunicorn_args():
+    """Флаги gunicorn из строки web: Procfile, без самой команды и модуля приложения."""
+    with open(os.path.join(ROOT, 'Procfile'), encoding='utf-8') as f:
+        for line in f:
+            kind, _, command = line.partition(':')
+            if kind.strip() == 'web':
+                return [arg for arg in shlex.split(command)[1:] if arg != 'app:app']
+    raise RuntimeError('в Procfile нет строки web:')
+
+
+def run_gunicorn(database, plan, requests, workers, concurrency):
+    port = free_port()
+    env = dict(os.environ, AN30_DATABASE=database,
+               AN30_EXPORT_CACHE_DIR=an30.app.config['EXPORT_CACHE_DIR'],
+               AN30_METRICS_DIR=an30.app.config['METRICS_DIR'])
+    # --workers из командной строки замера идёт после флагов Procfile и заменяет их значение
+    worker_args = procfile_gunicorn_args() + (['--workers', str(workers)] if workers else [])
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', *worker_args,
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+        cwd=ROOT, env=env
+    )
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(base + '/', timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError('gunicorn не запустился')
+
+        def fetch(request_spec):
+            method, path, data = request_spec
+            body = urllib.parse.urlencode(data).encode() if data else None
+            request = urllib.request.Request(base + path, data=body, method=method)
+            t = time.perf_counter()
+            try:
+                urllib.request.urlopen(request, timeout=120).read()
+            except urllib.error.HTTPError as e:
+                e.read()
+            return time.perf_counter() - t
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for name, make_request in plan.items():
+                specs = [make_request() for _ in range(requests)]
+                started = time.perf_counter()
+                timings = list(pool.map(fetch, specs))
+                results[name] = summarize(timings, time.perf_counter() - started)
+        return results
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def print_results(results):
+    print(f"{'набор':>12} {'маршрут':<15} {'запросов':>8} {'req/s':>9} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for dataset, routes in results.items():
+        for name, stats in routes.items():
+            print(f"{dataset:>12} {name:<15} {stats['requests']:>8} {stats['rps']:>9.1f} "
+                  f"{stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+
+
+def compare(results, baseline):
+    regressions = []
+    for dataset, routes in results.items():
+        for name, stats in routes.items():
+            old = baseline.get(dataset, {}).get(name)
+            if old and stats['p95_ms'] > old['p95_ms'] * REGRESSION_FACTOR:
+                regressions.append(f"{dataset} {name}: p95 {old['p95_ms']:.1f} -> {stats['p95_ms']:.1f} мс")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--machines', type=int, default=30)
+    parser.add_argument('--drivers', type=int, default=40)
+    parser.add_argument('--counterparties', type=int, default=15)
+    parser.add_argument('--days', type=int, nargs='+', default=[90, 365],
+                        help='размеры наборов данных в днях истории')
+    parser.add_argument('--requests', type=int, default=100, help='запросов на маршрут')
+    parser.add_argument('--seed', type=int, default=30)
+    parser.add_argument('--cold', action='store_true', help='сбрасывать кэш страниц перед каждым запросом')
+    parser.add_argument('--gunicorn', action='store_true', help='гонять запросы через локальный gunicorn')
+    parser.add_argument('--workers', type=int, help='число воркеров gunicorn; по умолчанию как в Procfile')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--save', help='сохранить результаты как базовый замер (JSON)')
+    parser.add_argument('--compare', help='сравнить с базовым замером; код выхода 1 при регрессии')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='an30_bench_')
+    an30.app.config['EXPORT_CACHE_DIR'] = os.path.join(tmp, 'exports')
+    an30.app.config['METRICS_DIR'] = os.path.join(tmp, 'metrics')
+    results = {}
+    try:
+        for days in args.days:
+            database = os.path.join(tmp, f'bench_{days}.db')
+            an30.app.config['DATABASE'] = database
+            an30.init_db()
+            conn = an30.connect_db()
+            an30.seed_db(conn, args.machines, args.drivers, args.counterparties, days, args.seed)
+            records = conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+            conn.close()
+            print(f'{days}d: записей {records}', file=sys.stderr)
+
+            plan = route_plan(args.machines, random.Random(args.seed))
+            if args.gunicorn:
+                routes = run_gunicorn(database, plan, args.requests, args.workers, args.concurrency)
+            else:
+                routes = run_client(database, plan, args.requests, args.cold)
+            results[f'{days}d'] = routes
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print_results(results)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f))
+        for line in regressions:
+            print(f'РЕГРЕССИЯ: {line}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
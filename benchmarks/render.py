@@ -0,0 +1,95 @@
+"""Замер рендеринга таблицы записей: старая сборка f-строками против шаблона Jinja.
+
+Запуск из корня проекта:
+    python benchmarks/render.py [--rows 1000 10000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template
+
+from app import app, init_db, COLORS, RECORDS_PAGE_SIZES, STATUS_LABELS
+
+
+def legacy_rows(records):
+    # так строки таблицы собирались до перехода на шаблоны
+    return ''.join(f'''
+                <tr>
+                    <td>{datetime.strptime(row[1], '%Y-%m-%d').strftime('%d.%m.%Y')}</td>
+                    <td>{row[2]}</td>
+                    <td>{row[3]}</td>
+                    <td>{f"{row[4]} - {row[5]}" if row[4] and row[5] else "-"}</td>
+                    <td>{row[6] or "0"}</td>
+                    <td>{row[8] or "-"}</td>
+                    <td>{row[7] or "-"}</td>
+                    <td>
+                        <div class="status" style="background: {COLORS['status'].get(row[9], '#ffffff')}">
+                            {row[9].capitalize()}
+                        </div>
+                    </td>
+                    <td>
+                        <form method="POST" action="/delete/record/{row[0]}">
+                            <button type="submit" class="btn btn-danger"
+                                onclick="return confirmDelete('Удалить запись?')">
+                                Удалить
+                            </button>
+                        </form>
+                    </td>
+                </tr>
+                ''' for row in records)
+
+
+def make_records(count):
+    statuses = list(STATUS_LABELS)
+    return [
+        (i, f'2026-{i % 12 + 1:02d}-{i % 28 + 1:02d}', f'Техника {i % 80}', f'Водитель {i % 120}',
+         '08:00', '17:00', 9, 'Комментарий', f'Контрагент {i % 30}', statuses[i % 4])
+        for i in range(count)
+    ]
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # списки техники и водителей в форме берутся из базы, хватит пустой
+    tmp = tempfile.TemporaryDirectory()
+    app.config['DATABASE'] = os.path.join(tmp.name, 'render.db')
+    init_db()
+
+    with app.test_request_context('/admin/records'):
+        print(f"{'строк':>8} {'f-строки, мс':>14} {'шаблон, мс':>12}")
+        for count in args.rows:
+            records = make_records(count)
+            legacy = best_time(lambda: legacy_rows(records), args.repeat)
+            template = best_time(lambda: render_template(
+                'admin_records.html',
+                records=records,
+                filters={},
+                per_page=RECORDS_PAGE_SIZES[0],
+                page_sizes=RECORDS_PAGE_SIZES,
+                nav_links=[]
+            ), args.repeat)
+            print(f"{count:>8} {legacy * 1000:>14.1f} {template * 1000:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
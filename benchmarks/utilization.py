@@ -0,0 +1,110 @@
+"""Замер аналитики по технике: NumPy (analytics.py) против построчного цикла по records.
+
+Обе версии считают одно и то же за весь период на синтетической базе и сверяются.
+NumPy-версия идёт тем же путём, что страница /analytics: analytics_report на
+соединении запроса (get_db, с замером времени запросов).
+Запуск из корня проекта:
+    python benchmarks/utilization.py [--days 365 1825] [--machines 30] [--repeat 3]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from app import analytics_report, app, connect_db, get_db, get_lookups, init_db, seed_db
+
+
+def naive_stats(conn, date_from, date_to):
+    # так сводка считалась бы циклом по строкам: множества дней и словари по (техника, месяц)
+    groups = {}
+    for date, machine_id, status, hours in conn.execute(
+            'SELECT date, machine_id, status, hours FROM records WHERE date BETWEEN ? AND ?', (date_from, date_to)):
+        group = groups.setdefault((machine_id, date[:7]), {
+            'records': 0, 'work_hours': 0, 'work': set(), 'repair': set(), 'stop': set()
+        })
+        group['records'] += 1
+        if status == 'work':
+            group['work_hours'] += hours or 0
+        if status in ('work', 'repair', 'stop'):
+            group[status].add(datetime.strptime(date, '%Y-%m-%d'))
+
+    first = datetime.strptime(date_from, '%Y-%m-%d')
+    last = datetime.strptime(date_to, '%Y-%m-%d')
+    month_days = {}
+    day = first
+    while day <= last:
+        month_days[day.strftime('%Y-%m')] = month_days.get(day.strftime('%Y-%m'), 0) + 1
+        day += timedelta(days=1)
+
+    machines = get_lookups(conn)['machines']
+    result = {}
+    for (machine_id, month), group in groups.items():
+        streaks = longest = run = 0
+        previous = None
+        for day in sorted(group['stop']):
+            run = run + 1 if previous and day - previous == timedelta(days=1) else 1
+            streaks += run == 1
+            longest = max(longest, run)
+            previous = day
+        result[(month, machines[machine_id])] = (
+            group['records'], len(group['work']),
+            round(100.0 * len(group['work']) / month_days[month], 1), group['work_hours'],
+            len(group['repair']), len(group['stop']), streaks, longest
+        )
+    return result
+
+
+def numpy_stats(date_from, date_to):
+    report = analytics_report(get_db(), [], [], date_from, date_to)
+    return {(row[0], row[1]): tuple(row[2:]) for row in report['months']}
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, nargs='+', default=[365, 1825])
+    parser.add_argument('--machines', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='an30_analytics_')
+    try:
+        print(f"{'дней':>6} {'записей':>9} {'цикл, мс':>10} {'NumPy, мс':>10} {'ускорение':>10}")
+        for days in args.days:
+            app.config['DATABASE'] = os.path.join(tmp, f'analytics_{days}.db')
+            init_db()
+            conn = connect_db()
+            seed_db(conn, args.machines, 40, 15, days, 30)
+            date_from, date_to = conn.execute('SELECT MIN(date), MAX(date) FROM records').fetchone()
+            records = conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+            naive, expected = best_time(lambda: naive_stats(conn, date_from, date_to), args.repeat)
+            conn.close()
+            with app.test_request_context('/analytics'):
+                vectorized, actual = best_time(lambda: numpy_stats(date_from, date_to), args.repeat)
+            if expected.keys() != actual.keys() or any(
+                    not np.allclose(expected[key], actual[key]) for key in expected):
+                raise SystemExit(f'{days}d: результаты NumPy и цикла не совпадают')
+            print(f"{days:>6} {records:>9} {naive * 1000:>10.1f} {vectorized * 1000:>10.1f} {naive / vectorized:>9.1f}x")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
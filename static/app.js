@@ -0,0 +1,96 @@
+function confirmDelete(msg) {
+    return confirm(msg || 'Вы уверены что хотите удалить запись?');
+}
+
+// Живое обновление по событиям /events: календарь перерисовывает изменённые дни,
+// первая страница записей вставляет новые строки на место и убирает удалённые.
+// Изменения за 0,3 с забираются одним запросом.
+function fetchHtml(url, done) {
+    fetch(url)
+        .then(function (response) { return response.text(); })
+        .then(function (html) {
+            var box = document.createElement('tbody');
+            box.innerHTML = html;
+            done(box);
+        });
+}
+
+function liveCalendar(grid) {
+    var machineId = grid.dataset.liveCalendar;
+    var pending = [];
+    var source = new EventSource('/events?machine_id=' + machineId + '&last_id=' + grid.dataset.lastChange);
+    function refresh() {
+        var dates = pending.sort();
+        pending = [];
+        fetchHtml('/calendar/' + machineId + '/days?date_from=' + dates[0] + '&date_to=' + dates[dates.length - 1], function (box) {
+            box.querySelectorAll('.calendar-day').forEach(function (cell) {
+                var old = grid.querySelector('.calendar-day[data-date="' + cell.dataset.date + '"]');
+                if (old) old.replaceWith(cell);
+            });
+        });
+    }
+    function changed(event) {
+        var date = JSON.parse(event.data).date;
+        if (!date || !grid.querySelector('.calendar-day[data-date="' + date + '"]')) return;
+        if (!pending.length) setTimeout(refresh, 300);
+        if (pending.indexOf(date) < 0) pending.push(date);
+    }
+    source.addEventListener('add', changed);
+    source.addEventListener('delete', changed);
+    source.addEventListener('reset', function () { location.reload(); });
+}
+
+function liveRecords(table) {
+    // порядок страницы — (дата, id) по убыванию
+    var filters = JSON.parse(table.dataset.filters);
+    var perPage = +table.dataset.perPage;
+    var pending = [];
+    var source = new EventSource('/events?last_id=' + table.dataset.lastChange);
+    function before(a, b) {
+        return a.dataset.date > b.dataset.date || (a.dataset.date === b.dataset.date && +a.dataset.id > +b.dataset.id);
+    }
+    function insert(row) {
+        var rows = table.querySelectorAll('tr[data-id]');
+        if (table.querySelector('tr[data-id="' + row.dataset.id + '"]')) return;
+        for (var i = 0; i < rows.length; i++) {
+            if (before(row, rows[i])) {
+                rows[i].before(row);
+                if (rows.length + 1 > perPage) rows[rows.length - 1].remove();
+                return;
+            }
+        }
+        if (rows.length < perPage) table.tBodies[0].appendChild(row);
+    }
+    function refresh() {
+        var params = new URLSearchParams(filters);
+        params.set('ids', pending.join(','));
+        pending = [];
+        fetchHtml('/admin/records/rows?' + params, function (box) {
+            Array.prototype.slice.call(box.rows).forEach(insert);
+        });
+    }
+    source.addEventListener('add', function (event) {
+        if (!pending.length) setTimeout(refresh, 300);
+        pending.push(JSON.parse(event.data).record_id);
+    });
+    source.addEventListener('delete', function (event) {
+        var row = table.querySelector('tr[data-id="' + JSON.parse(event.data).record_id + '"]');
+        if (row) row.remove();
+    });
+    source.addEventListener('reset', function () { location.reload(); });
+}
+
+// Флажок в заголовке отмечает все строки, привязанные к той же форме
+function selectAll(box) {
+    box.addEventListener('change', function () {
+        document.querySelectorAll('input[form="' + box.dataset.selectAll + '"]').forEach(function (item) {
+            item.checked = box.checked;
+        });
+    });
+}
+
+document.addEventListener('DOMContentLoaded', function () {
+    document.querySelectorAll('[data-select-all]').forEach(selectAll);
+    document.querySelectorAll('[data-live-calendar]').forEach(liveCalendar);
+    document.querySelectorAll('[data-live-records]').forEach(liveRecords);
+});